@@ -151,3 +151,88 @@ def gauss_factor(beamConv, beamOrig=None, dx1=1, dy1=1):
     fac = ((math.sqrt(dx1 ** 2) * math.sqrt(dy1 ** 2))) / amp
 
     return fac, amp, bmaj , bmin , np.degrees(bpa)
+
+
+def gaussianDeconvolve_array(smaj, smin, spa, bmaj, bmin, bpa):
+    """Array version of gaussianDeconvolve
+
+    Takes arrays (broadcast against each other) of the same parameters as
+    gaussianDeconvolve, and gives the same results element by element, to
+    rounding (numpy's cos and sin can differ from math's in the last bit).
+
+    Returns dmaj, dmin, dpa arrays
+    """
+    smaj, smin, spa, bmaj, bmin, bpa = np.broadcast_arrays(
+        *(np.asarray(x, dtype=float) for x in (smaj, smin, spa, bmaj, bmin, bpa))
+    )
+    spa = np.radians(spa)
+    bpa = np.radians(bpa)
+    smaj = np.where(smaj < bmaj, bmaj, smaj)
+    smin = np.where(smin < bmin, bmin, smin)
+
+    alpha = ((smaj * np.cos(spa))**2 + (smin * np.sin(spa))**2 -
+             (bmaj * np.cos(bpa))**2 - (bmin * np.sin(bpa))**2)
+    beta = ((smaj * np.sin(spa))**2 + (smin * np.cos(spa))**2 -
+            (bmaj * np.sin(bpa))**2 - (bmin * np.cos(bpa))**2)
+    gamma = 2 * ((smin**2 - smaj**2) * np.sin(spa) * np.cos(spa) -
+                 (bmin**2 - bmaj**2) * np.sin(bpa) * np.cos(bpa))
+    s = alpha + beta
+    t = np.sqrt((alpha - beta)**2 + gamma**2)
+    with np.errstate(invalid="ignore"):
+        dmaj = np.sqrt(0.5 * (s + t))
+        dmin = np.where(s > t, np.sqrt(0.5 * (s - t)), 0.0)
+    dpa = np.where(np.abs(gamma) + np.abs(alpha - beta) == 0,
+                   0.0, 0.5 * np.arctan2(-gamma, alpha - beta))
+    # As in gaussianDeconvolve, the position angle is kept on failure
+    fail = (alpha < 0) | (beta < 0)
+    dmaj = np.where(fail, 0.0, dmaj)
+    dmin = np.where(fail, 0.0, dmin)
+
+    return dmaj, dmin, np.degrees(dpa)
+
+
+def gauss_factor_array(beamConv, beamOrig, dx1=1, dy1=1):
+    """Array version of gauss_factor
+
+    Takes the same parameters as gauss_factor, but with each of
+    [major axis, minor axis, position_angle] an array (e.g. one element
+    per channel), and gives the same results element by element, to
+    rounding (numpy's cos and sin can differ from math's in the last bit).
+
+    Returns
+    -------
+    fac, amp, bmaj, bmin, bpa : arrays
+        As for gauss_factor.
+    """
+    deg2Grad = (np.pi / 180)
+    bmaj2, bmin2, bpa2 = (np.asarray(x, dtype=float) for x in beamConv)
+    bmaj1, bmin1, bpa1 = (np.asarray(x, dtype=float) for x in beamOrig)
+    bpa2 = bpa2 * deg2Grad
+    bpa1 = bpa1 * deg2Grad
+    cospa1 = np.cos(bpa1)
+    cospa2 = np.cos(bpa2)
+    sinpa1 = np.sin(bpa1)
+    sinpa2 = np.sin(bpa2)
+    alpha = ((bmaj1 * cospa1) ** 2
+             + (bmin1 * sinpa1) ** 2
+             + (bmaj2 * cospa2) ** 2
+             + (bmin2 * sinpa2) ** 2)
+    beta = ((bmaj1 * sinpa1) ** 2
+            + (bmin1 * cospa1) ** 2
+            + (bmaj2 * sinpa2) ** 2
+            + (bmin2 * cospa2) ** 2)
+    gamma = (2 * ((bmin1 ** 2 - bmaj1 ** 2)
+                  * sinpa1 * cospa1
+                  + (bmin2 ** 2 - bmaj2 ** 2)
+                  * sinpa2 * cospa2))
+    s = alpha + beta
+    t = np.sqrt((alpha - beta) ** 2 + gamma ** 2)
+    bmaj = np.sqrt(0.5 * (s + t))
+    bmin = np.sqrt(0.5 * (s - t))
+    bpa = np.where((np.abs(gamma) + np.abs(alpha - beta)) == 0,
+                   0.0, 0.5 * np.arctan2(-1 * gamma, alpha - beta))
+    amp = (math.pi / (4.0 * math.log(2.0)) * bmaj1 * bmin1 * bmaj2 * bmin2
+           / np.sqrt(alpha * beta - 0.25 * gamma * gamma))
+    fac = ((math.sqrt(dx1 ** 2) * math.sqrt(dy1 ** 2))) / amp
+
+    return fac, amp, bmaj, bmin, np.degrees(bpa)
@@ -4,6 +4,7 @@ __author__ = "Alec Thomson"
 
 import os
 import sys
+import time
 import numpy as np
 import scipy.signal
 from astropy import units as u
@@ -11,13 +12,16 @@ from astropy.io import fits, ascii
 import astropy.wcs
 from astropy.convolution import convolve, convolve_fft
 from astropy.table import Table
-from radio_beam import Beam, Beams
-from radio_beam.utils import BeamError
+from radio_beam import Beam
 from racs_tools import au2
 from racs_tools import convolve_uv
+from racs_tools import fft_backends
+from racs_tools import conv_model
+from racs_tools import zarr_store
+from racs_tools.beamtable import BeamTable
+from racs_tools.commonbeam import common_beam
 import schwimmbad
 import psutil
-from tqdm import tqdm
 import logging as log
 
 #######################################
@@ -25,15 +29,6 @@ import logging as log
 #######################################
 
 
-def round_up(n, decimals=0):
-    multiplier = 10 ** decimals
-    return np.ceil(n * multiplier) / multiplier
-
-
-def my_ceil(a, precision=0):
-    return np.round(a + 0.5 * 10 ** (-precision), precision)
-
-
 def getbeam(datadict, new_beam, cutoff=None):
     """Get beam info"""
     log.info(f"Current beam is {datadict['oldbeam']!r}")
@@ -117,7 +112,9 @@ def getimdata(cubenm):
     return datadict
 
 
-def smooth(datadict, conv_mode="robust"):
+def smooth(
+    datadict, conv_mode="robust", precision="float64", backend=None, pad=False
+):
     """Do the smoothing"""
     if np.isnan(datadict["sfactor"]):
         log.warning("Beam larger than cutoff -- blanking")
@@ -130,32 +127,37 @@ def smooth(datadict, conv_mode="robust"):
         log.info(f'Using convolving beam {datadict["conbeam"]!r}')
         pix_scale = datadict["dy"]
 
-        gauss_kern = datadict["conbeam"].as_kernel(pix_scale)
-        conbm1 = gauss_kern.array / gauss_kern.array.max()
+        if conv_mode not in ("robust", "robust_nan"):
+            gauss_kern = datadict["conbeam"].as_kernel(pix_scale)
+            conbm1 = (gauss_kern.array / gauss_kern.array.max()).astype(precision)
+        # Cast in a buffer that is reused from image to image
+        image = convolve_uv.work_buffer("image", datadict["image"].shape, precision)
+        image[...] = datadict["image"]
         fac = datadict["sfactor"]
-        if conv_mode == "robust":
+        if conv_mode in ("robust", "robust_nan"):
             newim, fac = convolve_uv.convolve(
-                datadict["image"].astype("f8"),
+                image,
                 datadict["oldbeam"],
                 datadict["final_beam"],
                 datadict["dx"],
                 datadict["dy"],
+                backend=backend,
+                pad=pad,
+                nan_aware=(conv_mode == "robust_nan"),
             )
             # keep the new sfactor computed by this method
             datadict["sfactor"] = fac
         if conv_mode == "scipy":
-            newim = scipy.signal.convolve(
-                datadict["image"].astype("f8"), conbm1, mode="same"
-            )
+            newim = scipy.signal.convolve(image, conbm1, mode="same")
         elif conv_mode == "astropy":
             newim = convolve(
-                datadict["image"].astype("f8"),
+                image,
                 conbm1,
                 normalize_kernel=False,
             )
         elif conv_mode == "astropy_fft":
             newim = convolve_fft(
-                datadict["image"].astype("f8"),
+                image,
                 conbm1,
                 normalize_kernel=False,
                 allow_huge=True,
@@ -168,15 +170,103 @@ def smooth(datadict, conv_mode="robust"):
         return newim
 
 
-def savefile(datadict, filename, outdir="."):
+def smooth_tiled(
+    datadict,
+    outfile,
+    max_memory,
+    conv_mode="robust",
+    precision="float64",
+    backend=None,
+):
+    """Do the smoothing out of core, tile by tile, straight into outfile"""
+    log.info(f'Smoothing so beam is {datadict["final_beam"]!r}')
+    log.info(f'Using convolving beam {datadict["conbeam"]!r}')
+    log.info(f"Streaming to {outfile} in tiles of at most {max_memory} bytes")
+    header = datadict["final_beam"].attach_to_header(datadict["header"])
+    shape = datadict["image"].shape
+    if datadict["4d"]:
+        shape = (1, 1) + shape
+    init_outfile(outfile, header, shape)
+    with fits.open(outfile, mode="update", memmap=True) as hdu:
+        out = hdu[0].data[0, 0] if datadict["4d"] else hdu[0].data
+        fac = convolve_uv.convolve_tiled(
+            datadict["image"],
+            out,
+            datadict["oldbeam"],
+            datadict["final_beam"],
+            datadict["dx"],
+            datadict["dy"],
+            max_memory,
+            backend=backend,
+            nan_aware=(conv_mode == "robust_nan"),
+            dtype=precision,
+        )
+        del out
+    log.info(f"Using scaling factor {fac}")
+    datadict["sfactor"] = fac
+
+
+def saveblank(datadict, outfile, output_format="fits"):
+    """Write a NaN image straight to disk, without reading the input"""
+    log.warning("Beam larger than cutoff -- blanking")
+    log.info(f"Saving to {outfile}")
+    header = datadict["final_beam"].attach_to_header(datadict["header"])
+    shape = datadict["image"].shape
+    if datadict["4d"]:
+        shape = (1, 1) + shape
+    if output_format == "zarr":
+        # Unwritten pixels of a store are NaN
+        zarr_store.init_store(outfile, header, shape)
+        return
+    init_outfile(outfile, header, shape)
+    with fits.open(outfile, mode="update", memmap=True) as hdu:
+        hdu[0].data[...] = np.nan
+
+
+def init_outfile(outfile, header, shape, bitpix=-32):
+    """Create a FITS file without writing its data
+
+    Only the header is written. The data section is allocated as a sparse
+    file of zeros, to be filled in later (e.g. through a memmap).
+
+    Args:
+        outfile (str): Name of the file to create. Overwritten if it exists.
+        header (Header): Primary header.
+        shape (tuple): Shape of the data, in numpy order.
+        bitpix (int, optional): BITPIX of the data. Defaults to -32.
+    """
+    header = header.copy()
+    for key in ("BSCALE", "BZERO", "BLANK", "CHECKSUM", "DATASUM"):
+        header.remove(key, ignore_missing=True)
+    header["BITPIX"] = bitpix
+    header["NAXIS"] = len(shape)
+    for i, n in enumerate(shape[::-1], start=1):
+        header.set(f"NAXIS{i}", n, after="NAXIS" if i == 1 else f"NAXIS{i-1}")
+    header.tofile(outfile, overwrite=True)
+    nbytes = int(np.prod(shape)) * abs(bitpix) // 8
+    # Pad to a whole number of 2880 byte FITS blocks
+    nbytes = -(-nbytes // 2880) * 2880
+    with open(outfile, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        f.truncate(f.tell() + nbytes)
+
+
+def savefile(datadict, filename, outdir=".", output_format="fits"):
     """Save file to disk"""
     outfile = f"{outdir}/{filename}"
     log.info(f"Saving to {outfile}")
     header = datadict["header"]
     beam = datadict["final_beam"]
     header = beam.attach_to_header(header)
+    if output_format == "zarr":
+        newim = datadict["newimage"]
+        zarr_store.init_store(outfile, header, newim.shape)[...] = newim
+        return
     fits.writeto(
-        outfile, datadict["newimage"].astype(np.float32), header=header, overwrite=True
+        outfile,
+        datadict["newimage"].astype(np.float32, copy=False),
+        header=header,
+        overwrite=True,
     )
 
 
@@ -194,6 +284,17 @@ def worker(args):
     outfile = outfile.replace(".fits", f".{clargs.suffix}.fits")
     if clargs.prefix is not None:
         outfile = clargs.prefix + outfile
+    output_format = clargs.output_format
+    if (
+        output_format == "zarr"
+        and clargs.max_memory is not None
+        and conv_mode in ("robust", "robust_nan", "auto")
+    ):
+        # Tiles are streamed through a memmap, which needs FITS
+        log.warning("Tiling with --max-memory -- writing FITS, not Zarr")
+        output_format = "fits"
+    if output_format == "zarr":
+        outfile = zarr_store.storename(outfile)
     datadict = getimdata(file)
 
     conbeam, sfactor = getbeam(
@@ -204,29 +305,78 @@ def worker(args):
 
     datadict.update({"conbeam": conbeam, "final_beam": new_beam, "sfactor": sfactor})
     if not clargs.dryrun:
-        if (
+        backend = fft_backends.get_backend(clargs.fft_backend, clargs.fft_threads)
+        if np.isnan(sfactor):
+            newim = None
+            saveblank(datadict, f"{outdir}/{outfile}", output_format=output_format)
+            datadict["skipped"] = datadict["image"].nbytes
+        elif (
             conbeam == Beam(major=0 * u.deg, minor=0 * u.deg, pa=0 * u.deg)
             and sfactor == 1
         ):
             newim = datadict["image"]
+        elif (
+            clargs.max_memory is not None
+            and conv_mode in ("robust", "robust_nan", "auto")
+            and not np.isnan(sfactor)
+        ):
+            newim = None
+            smooth_tiled(
+                datadict,
+                f"{outdir}/{outfile}",
+                int(clargs.max_memory * 2 ** 20),
+                # Only the robust methods can be tiled
+                conv_mode="robust_nan" if conv_mode == "auto" else conv_mode,
+                precision=clargs.precision,
+                backend=backend,
+            )
+        elif conv_mode == "auto" and not np.isnan(sfactor):
+            model = conv_model.get_model(backend, clargs.pad)
+            choice = model.choose(
+                datadict["image"].shape,
+                conbeam,
+                new_beam,
+                datadict["dx"],
+                datadict["dy"],
+                has_nans=np.isnan(datadict["image"]).any(),
+                name=file,
+            )
+            tic = time.perf_counter()
+            newim = smooth(
+                datadict,
+                conv_mode=choice.method,
+                precision=clargs.precision,
+                backend=backend,
+                pad=clargs.pad,
+            )
+            model.update(choice, time.perf_counter() - tic)
         else:
-            newim = smooth(datadict, conv_mode=conv_mode)
-        if datadict["4d"]:
-            # make it back into a 4D image
-            newim = np.expand_dims(np.expand_dims(newim, axis=0), axis=0)
-        datadict.update(
-            {
-                "newimage": newim,
-            }
-        )
+            newim = smooth(
+                datadict,
+                conv_mode=conv_mode,
+                precision=clargs.precision,
+                backend=backend,
+                pad=clargs.pad,
+            )
+        if newim is not None:
+            if datadict["4d"]:
+                # make it back into a 4D image
+                newim = np.expand_dims(np.expand_dims(newim, axis=0), axis=0)
+            datadict.update(
+                {
+                    "newimage": newim,
+                }
+            )
 
-        savefile(datadict, outfile, outdir)
+            savefile(datadict, outfile, outdir, output_format=output_format)
+        if output_format == "zarr" and clargs.finalise:
+            zarr_store.to_fits(f"{outdir}/{outfile}")
 
     # Remove image data from datadict. It's not used beyond this point and can cause
     # overflow errors when using MPI as it tries to send the image data back to the main
     # process.
     del datadict["image"]
-    del datadict["newimage"]
+    datadict.pop("newimage", None)
 
     return datadict
 
@@ -241,41 +391,17 @@ def getmaxbeam(
     epsilon=0.0005,
 ):
     """Get smallest common beam"""
-    beams = []
-    for file in files:
-        header = fits.getheader(file, memmap=True)
-        beam = Beam.from_fits_header(header)
-        beams.append(beam)
-
-    beams = Beams(
-        [beam.major.to(u.deg).value for beam in beams] * u.deg,
-        [beam.minor.to(u.deg).value for beam in beams] * u.deg,
-        [beam.pa.to(u.deg).value for beam in beams] * u.deg,
-    )
+    headers = [fits.getheader(file, memmap=True) for file in files]
+    beams = BeamTable.from_beams([Beam.from_fits_header(header) for header in headers])
     if cutoff is not None:
-        flags = beams.major > cutoff * u.arcsec
+        flags = beams.major > cutoff
     else:
-        flags = np.array([False for beam in beams])
-    try:
-        cmn_beam = beams[~flags].common_beam(
-            tolerance=tolerance, epsilon=epsilon, nsamps=nsamps
-        )
-    except BeamError:
-        log.warning(
-            "Couldn't find common beam with defaults\nTrying again with smaller"
-            " tolerance"
-        )
-        cmn_beam = beams[~flags].common_beam(
-            tolerance=tolerance * 0.1, epsilon=epsilon, nsamps=nsamps
-        )
-
+        flags = np.zeros(len(beams), dtype=bool)
     # Round up values
-    cmn_beam = Beam(
-        major=my_ceil(cmn_beam.major.to(u.arcsec).value, precision=1) * u.arcsec,
-        minor=my_ceil(cmn_beam.minor.to(u.arcsec).value, precision=1) * u.arcsec,
-        pa=round_up(cmn_beam.pa.to(u.deg), decimals=2),
-    )
-    target_header = header
+    cmn_beam = common_beam(
+        beams[~flags], tolerance=tolerance, epsilon=epsilon, nsamps=nsamps
+    ).round_up()
+    target_header = headers[-1]
     w = astropy.wcs.WCS(target_header)
     pixelscales = astropy.wcs.utils.proj_plane_pixel_scales(w)
 
@@ -283,28 +409,17 @@ def getmaxbeam(
     dy = pixelscales[1] * u.deg
     if not dx == dy:
         raise Exception("GRID MUST BE SAME IN X AND Y")
-    grid = dy
-    if conv_mode != "robust":
+    grid = dy.to_value(u.arcsec)
+    if conv_mode not in ("robust", "robust_nan", "auto"):
         # Get the minor axis of the convolving beams
-        minorcons = []
-        for beam in beams:
-            minorcons += [cmn_beam.deconvolve(beam).minor.to(u.arcsec).value]
-        minorcons = np.array(minorcons) * u.arcsec
-        samps = minorcons / grid.to(u.arcsec)
+        samps = cmn_beam.deconvolve(beams).minor / grid
         # Check that convolving beam will be Nyquist sampled
-        if any(samps.value < 2):
+        if any(samps < 2):
             # Set the convolving beam to be Nyquist sampled
-            nyq_con_beam = Beam(major=grid * 2, minor=grid * 2, pa=0 * u.deg)
+            nyq_con_beam = BeamTable(grid * 2, grid * 2, 0)
             # Find new target based on common beam * Nyquist beam
             # Not sure if this is best - but it works
-            nyq_beam = cmn_beam.convolve(nyq_con_beam)
-            nyq_beam = Beam(
-                major=my_ceil(nyq_beam.major.to(u.arcsec).value, precision=1)
-                * u.arcsec,
-                minor=my_ceil(nyq_beam.minor.to(u.arcsec).value, precision=1)
-                * u.arcsec,
-                pa=round_up(nyq_beam.pa.to(u.deg), decimals=2),
-            )
+            nyq_beam = cmn_beam.convolve(nyq_con_beam).round_up().to_beam()
             log.info(f"Smallest common Nyquist sampled beam is: {nyq_beam!r}")
             if target_beam is not None:
                 if target_beam < nyq_beam:
@@ -313,9 +428,9 @@ def getmaxbeam(
             else:
                 log.warn("COMMON BEAM WILL BE UNDERSAMPLED!")
                 log.warn("SETTING COMMON BEAM TO NYQUIST BEAM")
-                cmn_beam = nyq_beam
+                cmn_beam = BeamTable.from_beams(nyq_beam)
 
-    return cmn_beam, beams
+    return cmn_beam.to_beam(), beams, flags
 
 
 def writelog(output, commonbeam_log):
@@ -327,45 +442,20 @@ def writelog(output, commonbeam_log):
     """
     commonbeam_tab = Table()
     commonbeam_tab.add_column([out["filename"] for out in output], name="FileName")
-    # Origina
-    commonbeam_tab.add_column(
-        [out["oldbeam"].major.to(u.deg).value for out in output] * u.deg,
-        name="Original BMAJ",
-    )
-    commonbeam_tab.add_column(
-        [out["oldbeam"].minor.to(u.deg).value for out in output] * u.deg,
-        name="Original BMIN",
-    )
-    commonbeam_tab.add_column(
-        [out["oldbeam"].pa.to(u.deg).value for out in output] * u.deg,
-        name="Original BPA",
-    )
-    # Target
-    commonbeam_tab.add_column(
-        [out["final_beam"].major.to(u.deg).value for out in output] * u.deg,
-        name="Target BMAJ",
-    )
-    commonbeam_tab.add_column(
-        [out["final_beam"].minor.to(u.deg).value for out in output] * u.deg,
-        name="Target BMIN",
-    )
-    commonbeam_tab.add_column(
-        [out["final_beam"].pa.to(u.deg).value for out in output] * u.deg,
-        name="Target BPA",
-    )
-    # Convolving
-    commonbeam_tab.add_column(
-        [out["conbeam"].major.to(u.deg).value for out in output] * u.deg,
-        name="Convolving BMAJ",
-    )
-    commonbeam_tab.add_column(
-        [out["conbeam"].minor.to(u.deg).value for out in output] * u.deg,
-        name="Convolving BMIN",
-    )
-    commonbeam_tab.add_column(
-        [out["conbeam"].pa.to(u.deg).value for out in output] * u.deg,
-        name="Convolving BPA",
-    )
+    # Blanked images have a NaN convolving beam
+    for name, key in (
+        ("Original", "oldbeam"),
+        ("Target", "final_beam"),
+        ("Convolving", "conbeam"),
+    ):
+        beams = BeamTable.from_beams([out[key] for out in output])
+        commonbeam_tab.add_column(
+            (beams.major * u.arcsec).to(u.deg), name=f"{name} BMAJ"
+        )
+        commonbeam_tab.add_column(
+            (beams.minor * u.arcsec).to(u.deg), name=f"{name} BMIN"
+        )
+        commonbeam_tab.add_column(beams.pa * u.deg, name=f"{name} BPA")
 
     # Write to log file
     units = ""
@@ -401,16 +491,36 @@ def main(pool, args):
 
     conv_mode = args.conv_mode
     log.info(f"Convolution mode: {conv_mode}")
-    if conv_mode not in ["robust", "scipy", "astropy", "astropy_fft"]:
+    if conv_mode not in [
+        "robust",
+        "robust_nan",
+        "scipy",
+        "astropy",
+        "astropy_fft",
+        "auto",
+    ]:
         raise Exception("Please select valid convolution method!")
 
     log.info(f"Using convolution method {conv_mode}")
     if conv_mode == "robust":
         log.info("This is the most robust method. And fast!")
+    elif conv_mode == "robust_nan":
+        log.info("This is the robust method, with NaNs ignored. Still fast!")
     elif conv_mode == "scipy":
         log.info("This fast, but not robust to NaNs or small PSF changes")
+    elif conv_mode == "auto":
+        log.info("The fastest valid method will be chosen for each image")
     else:
         log.info("This is slower, but robust to NaNs, but not to small PSF changes")
+    if args.max_memory is not None and conv_mode not in (
+        "robust",
+        "robust_nan",
+        "auto",
+    ):
+        log.warning(
+            f"--max-memory only applies to the 'robust' methods -- "
+            f"'{conv_mode}' will hold each image in memory"
+        )
 
     bmaj = args.bmaj
     bmin = args.bmin
@@ -429,7 +539,7 @@ def main(pool, args):
         log.info(f"Target beam is {target_beam!r}")
 
     # Find smallest common beam
-    big_beam, allbeams = getmaxbeam(
+    big_beam, allbeams, flags = getmaxbeam(
         files,
         conv_mode=conv_mode,
         target_beam=target_beam,
@@ -442,22 +552,16 @@ def main(pool, args):
     if target_beam is not None:
         log.info("Checking that target beam will deconvolve...")
 
-        mask_count = 0
-        failed = []
-        for i, (beam, file) in enumerate(
-            tqdm(
-                zip(allbeams, files),
-                total=len(allbeams),
-                desc="Deconvolving",
-                disable=(log.root.level > log.INFO),
-            )
-        ):
-            try:
-                target_beam.deconvolve(beam)
-            except ValueError:
-                mask_count += 1
-                failed.append(file)
-        if mask_count > 0:
+        # Failed deconvolutions come back as point beams. Images beyond the
+        # cutoff are blanked, so they need not reach the target.
+        points = (
+            BeamTable.from_beams(target_beam)
+            .deconvolve(allbeams, failure_returns_pointlike=True)
+            .major
+            == 0
+        )
+        failed = list(np.array(files)[points & ~flags])
+        if len(failed) > 0:
             log.warn("The following images could not reach target resolution:")
             log.warn(failed)
 
@@ -481,6 +585,8 @@ def main(pool, args):
     inputs = [[file, outdir, new_beam, conv_mode, args] for i, file in enumerate(files)]
 
     output = list(pool.map(worker, inputs))
+    skipped = sum(out.get("skipped", 0) for out in output)
+    log.info(f"Skipped reading {(skipped*u.byte).to(u.MB)} of blanked images")
 
     if args.log is not None:
         writelog(output, args.log)
@@ -546,14 +652,90 @@ def cli():
     parser.add_argument(
         "--conv_mode",
         dest="conv_mode",
-        choices=["robust", "scipy", "astropy", "astropy_fft"],
+        choices=["robust", "robust_nan", "scipy", "astropy", "astropy_fft", "auto"],
         default="robust",
         help="""Which method to use for convolution [robust].
         'robust' uses the built-in, FFT-based method.
+        'robust_nan' is 'robust' with NaN pixels ignored (normalised convolution).
+        'auto' picks the fastest valid method for each image, using a cost
+        model calibrated at startup. The choice is logged (with -v). The other
+        methods differ from 'robust' by ~1%% of the peak, and the choice
+        depends on timings, so 'auto' can change the results from run to run.
         Note that other methods cannot cope well with small convolving beams.
         """,
     )
 
+    parser.add_argument(
+        "--precision",
+        dest="precision",
+        choices=["float64", "float32"],
+        default="float64",
+        help="""Floating point precision used for convolution [float64].
+        'float32' keeps the image, kernel and spectra in single precision.
+        Output images are always written as float32.
+        """,
+    )
+
+    parser.add_argument(
+        "--output-format",
+        dest="output_format",
+        choices=zarr_store.FORMATS,
+        default="fits",
+        help="""Format of the output images [fits].
+        'zarr' writes a Zarr store (<name>.zarr) per image, with the header and
+        beam in its attributes. Requires zarr to be installed. Images tiled
+        with --max-memory are always written as FITS.
+        """,
+    )
+
+    parser.add_argument(
+        "--finalise",
+        dest="finalise",
+        action="store_true",
+        help="""Convert Zarr outputs to FITS (<name>.fits) once written [False].
+        Stores can also be converted later with racs_tools.zarr_store.
+        """,
+    )
+
+    parser.add_argument(
+        "--fft-backend",
+        dest="fft_backend",
+        choices=fft_backends.BACKENDS,
+        default="scipy",
+        help="""FFT library used by the 'robust' method [scipy].
+        'pyfftw' requires pyFFTW to be installed.
+        """,
+    )
+
+    parser.add_argument(
+        "--pad",
+        action="store_true",
+        help="""Zero pad images to a fast FFT size in the 'robust' method [False].
+        Speeds up awkward image sizes and stops wrap-around at the edges.
+        """,
+    )
+
+    parser.add_argument(
+        "--max-memory",
+        dest="max_memory",
+        type=float,
+        default=None,
+        help="""Memory limit (MB) per image for the 'robust' methods [None -- no limit].
+        If set, images are streamed from disk and convolved in overlapping
+        tiles that fit in this limit, and written straight to the output.
+        Edges are zero padded, as with --pad. As in memory, a NaN anywhere in
+        an image makes the 'robust' output all NaN. Ignored by other methods.
+        """,
+    )
+
+    parser.add_argument(
+        "--fft-threads",
+        dest="fft_threads",
+        type=int,
+        default=None,
+        help="Threads per FFT [CPUs available / ncores, or / MPI ranks per node].",
+    )
+
     parser.add_argument(
         "-v", "--verbosity", default=0, action="count", help="Increase output verbosity"
     )
@@ -697,6 +879,11 @@ def cli():
             ),
             datefmt="%Y-%m-%d %H:%M:%S",
         )
+    if args.fft_threads is None:
+        if args.mpi:
+            args.fft_threads = fft_backends.mpi_threads(comm)
+        else:
+            args.fft_threads = max(1, fft_backends.default_threads() // args.n_cores)
     pool = schwimmbad.choose_pool(mpi=args.mpi, processes=args.n_cores)
     if args.mpi:
         if not pool.is_master():
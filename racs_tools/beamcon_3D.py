@@ -2,25 +2,42 @@
 """ Convolve ASKAP cubes to common resolution """
 __author__ = "Alec Thomson"
 
-from racs_tools.beamcon_2D import my_ceil, round_up
+from racs_tools.beamcon_2D import init_outfile
+from racs_tools.beamtable import BeamTable
+from racs_tools.commonbeam import (
+    CommonBeamSolver,
+    common_beam,
+    contains,
+    hull_beams,
+    merge_hulls,
+)
 from spectral_cube.utils import SpectralCubeWarning
 import warnings
 from astropy.utils.exceptions import AstropyWarning
 from astropy.convolution import convolve, convolve_fft
 from racs_tools import convolve_uv
+from racs_tools import fft_backends
+from racs_tools import conv_model
+from racs_tools import zarr_store
 import os
 import stat
 import sys
+import time
+import queue
+import collections
+import threading
+import functools
+from contextlib import nullcontext
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import scipy.signal
 from astropy import units as u
 from astropy.io import fits, ascii
 import astropy.wcs
 from astropy.table import Table
-from spectral_cube import SpectralCube
 from radio_beam import Beam, Beams
-from radio_beam.utils import BeamError
-from tqdm import tqdm, trange
+from tqdm import tqdm
 from racs_tools import au2
 import logging as log
 
@@ -173,31 +190,33 @@ def getfacs(datadict, convbeams):
     """ """Get beam info
     
     """
-    facs = []
-    for conbm, oldbeam in zip(convbeams, datadict["beams"]):
-        if conbm == Beam(major=0 * u.deg, minor=0 * u.deg, pa=0 * u.deg):
-            fac = 1
-        else:
-            fac, amp, outbmaj, outbmin, outbpa = au2.gauss_factor(
-                [
-                    conbm.major.to(u.arcsec).value,
-                    conbm.minor.to(u.arcsec).value,
-                    conbm.pa.to(u.deg).value,
-                ],
-                beamOrig=[
-                    oldbeam.major.to(u.arcsec).value,
-                    oldbeam.minor.to(u.arcsec).value,
-                    oldbeam.pa.to(u.deg).value,
-                ],
-                dx1=datadict["dx"].to(u.arcsec).value,
-                dy1=datadict["dy"].to(u.arcsec).value,
-            )
-        facs.append(fac)
-    facs = np.array(facs)
+    conbms = BeamTable.from_beams(convbeams)
+    oldbeams = BeamTable.from_beams(datadict["beams"])
+    facs = np.ones(len(conbms))
+    # No convolution for null beams
+    todo = conbms != BeamTable(0, 0, 0)
+    facs[todo], amps, outbmaj, outbmin, outbpa = au2.gauss_factor_array(
+        [conbms.major[todo], conbms.minor[todo], conbms.pa[todo]],
+        beamOrig=[oldbeams.major[todo], oldbeams.minor[todo], oldbeams.pa[todo]],
+        dx1=datadict["dx"].to(u.arcsec).value,
+        dy1=datadict["dy"].to(u.arcsec).value,
+    )
     return facs
 
 
-def smooth(image, dx, dy, oldbeam, newbeam, conbeam, sfactor, conv_mode="robust"):
+def smooth(
+    image,
+    dx,
+    dy,
+    oldbeam,
+    newbeam,
+    conbeam,
+    sfactor,
+    conv_mode="robust",
+    precision="float64",
+    backend=None,
+    pad=False,
+):
     """smooth an image in Jy/beam
 
     Args:
@@ -209,6 +228,9 @@ def smooth(image, dx, dy, oldbeam, newbeam, conbeam, sfactor, conv_mode="robust"
         conbeam (Beam): Convolving beam
         sfactor (float): factor to keep units in Jy/beam
         conv_mode (str): Convolution mode
+        precision (str, optional): Working precision. Defaults to 'float64'.
+        backend (optional): FFT backend for 'robust' mode.
+        pad (bool, optional): Pad to a fast FFT size in 'robust' mode.
 
     Returns:
         ndarray: Smoothed image
@@ -226,27 +248,160 @@ def smooth(image, dx, dy, oldbeam, newbeam, conbeam, sfactor, conv_mode="robust"
         log.debug(f"Target beam is {newbeam!r}")
         log.debug(f"Using scaling factor {sfactor}")
         pix_scale = dy
-        gauss_kern = conbeam.as_kernel(pix_scale)
-
-        conbm1 = gauss_kern.array / gauss_kern.array.max()
+        if conv_mode not in ("robust", "robust_nan"):
+            gauss_kern = conbeam.as_kernel(pix_scale)
+            conbm1 = (gauss_kern.array / gauss_kern.array.max()).astype(precision)
+        image = image.astype(precision, copy=False)
         fac = sfactor
-        if conv_mode == "robust":
+        if conv_mode in ("robust", "robust_nan"):
             newim, fac = convolve_uv.convolve(
-                image.astype("f8"), oldbeam, newbeam, dx, dy,
+                image,
+                oldbeam,
+                newbeam,
+                dx,
+                dy,
+                backend=backend,
+                pad=pad,
+                nan_aware=(conv_mode == "robust_nan"),
             )
         if conv_mode == "scipy":
-            newim = scipy.signal.convolve(image.astype("f8"), conbm1, mode="same")
+            newim = scipy.signal.convolve(image, conbm1, mode="same")
         elif conv_mode == "astropy":
-            newim = convolve(image.astype("f8"), conbm1, normalize_kernel=False,)
+            newim = convolve(image, conbm1, normalize_kernel=False,)
         elif conv_mode == "astropy_fft":
             newim = convolve_fft(
-                image.astype("f8"), conbm1, normalize_kernel=False, allow_huge=True,
+                image, conbm1, normalize_kernel=False, allow_huge=True,
             )
     log.debug(f"Using scaling factor {fac}")
     newim *= fac
     return newim
 
 
+def smooth_stack(
+    images,
+    dx,
+    dy,
+    oldbeams,
+    newbeams,
+    conbeams,
+    sfactors,
+    conv_mode="robust",
+    precision="float64",
+    backend=None,
+    pad=False,
+    names=None,
+):
+    """smooth a block of image planes in Jy/beam
+
+    In 'robust' and 'robust_nan' modes all planes that need convolving are
+    done together in one batched FFT. Otherwise each plane goes through
+    smooth. In 'auto' mode the method is chosen per plane, and planes that
+    get a 'robust' method share the batch.
+
+    The planes are smoothed in place. The batch is cast to the working
+    precision in a reusable buffer, unless it can be transformed as is.
+
+    Args:
+        images (ndarray): Image planes from FITS file (nchan, ny, nx)
+        dx (Quantity): deg per pixel in image
+        dy (Quantity): deg per pixel in image
+        oldbeams (Beams): Original PSFs
+        newbeams (Beams): Target PSFs
+        conbeams (Beams): Convolving beams
+        sfactors (ndarray): factors to keep units in Jy/beam
+        conv_mode (str): Convolution mode
+        precision (str, optional): Working precision. Defaults to 'float64'.
+        backend (optional): FFT backend for 'robust' mode.
+        pad (bool, optional): Pad to a fast FFT size in 'robust' mode.
+        names (list, optional): The planes, for the log in 'auto' mode.
+
+    Returns:
+        ndarray: images, smoothed in place
+    """
+    newims = images
+    nullbeam = Beam(major=0 * u.deg, minor=0 * u.deg, pa=0 * u.deg)
+    todo = np.zeros(len(images), dtype=bool)
+    if conv_mode == "auto":
+        model = conv_model.get_model(backend, pad)
+        predicted = 0
+    for i, (image, oldbeam, newbeam, conbeam, sfactor) in enumerate(
+        zip(images, oldbeams, newbeams, conbeams, sfactors)
+    ):
+        needs_conv = (
+            not np.isnan(conbeam)
+            and not np.isnan(image).all()
+            and not (conbeam == nullbeam and sfactor == 1)
+        )
+        mode, choice = conv_mode, None
+        if conv_mode == "auto" and needs_conv:
+            choice = model.choose(
+                image.shape,
+                conbeam,
+                newbeam,
+                dx,
+                dy,
+                has_nans=np.isnan(image).any(),
+                name=None if names is None else names[i],
+            )
+            mode = choice.method
+        if mode in ("robust", "robust_nan") and needs_conv:
+            todo[i] = True
+            if choice is not None:
+                predicted += choice.predicted
+        else:
+            tic = time.perf_counter()
+            newims[i] = smooth(
+                image=image,
+                dx=dx,
+                dy=dy,
+                oldbeam=oldbeam,
+                newbeam=newbeam,
+                conbeam=conbeam,
+                sfactor=sfactor,
+                conv_mode=mode,
+                precision=precision,
+                backend=backend,
+                pad=pad,
+            )
+            if choice is not None:
+                model.update(choice, time.perf_counter() - tic)
+    if todo.any():
+        log.debug(f"Convolving {todo.sum()} planes in one batch")
+        tic = time.perf_counter()
+        idx = np.flatnonzero(todo)
+        if todo.all() and images.dtype == np.dtype(precision):
+            stack = images
+        else:
+            stack = convolve_uv.work_buffer(
+                "stack", (len(idx),) + images.shape[1:], precision
+            )
+            for j, i in enumerate(idx):
+                stack[j] = images[i]
+        newim, facs = convolve_uv.convolve_stack(
+            stack,
+            oldbeams[todo],
+            newbeams[todo],
+            dx,
+            dy,
+            backend=backend,
+            pad=pad,
+            # NaN-aware is a no-op for planes without NaNs
+            nan_aware=(conv_mode in ("robust_nan", "auto")),
+            # Scaled and written back over the batch, a plane at a time
+            out=stack,
+        )
+        log.debug(f"Using scaling factors {facs}")
+        if stack is not images:
+            for j, i in enumerate(idx):
+                newims[i] = newim[j]
+        if conv_mode == "auto":
+            model.update(
+                conv_model.Choice("robust", predicted, "robust"),
+                time.perf_counter() - tic,
+            )
+    return newims
+
+
 def cpu_to_use(max_cpu, count):
     """Find number of cpus to use.
     Find the right number of cpus to use when dividing up a task, such
@@ -267,32 +422,888 @@ def cpu_to_use(max_cpu, count):
     return max(factors[factors <= max_cpu])
 
 
-def worker(idx, cubedict, conv_mode="robust", start=0):
+_cubes = {}
+_cubes_lock = threading.Lock()
+
+
+def specaxis(header):
+    """Get the numpy axis of the spectral axis of a cube
+
+    Args:
+        header (Header): FITS header of the cube
+
+    Returns:
+        int: Spectral axis. Defaults to the third FITS axis if none is found.
+    """
+    spec = astropy.wcs.WCS(header).wcs.spec
+    if spec < 0:
+        spec = 2
+    return header["NAXIS"] - 1 - spec
+
+
+def chanindex(ndim, axis, start, end):
+    """Index of planes start:end of a cube, with any Stokes axis at 0
+
+    Args:
+        ndim (int): Number of dimensions of the cube
+        axis (int): Spectral axis
+        start (int): First channel
+        end (int): Last channel + 1
+
+    Returns:
+        tuple: Index giving planes of shape (nchan, ny, nx)
+    """
+    return tuple(
+        slice(start, end) if i == axis else slice(None) if i >= ndim - 2 else 0
+        for i in range(ndim)
+    )
+
+
+def opencube(filename):
+    """Memory-map a cube, once per process
+
+    The file stays open, so later calls only cost a dict lookup.
+
+    Args:
+        filename (str): FITS cube
+
+    Returns:
+        tuple: (memory-mapped data, spectral axis)
+    """
+    with _cubes_lock:
+        if filename not in _cubes:
+            log.debug(f"Opening {filename}")
+            hdulist = fits.open(filename, memmap=True, mode="denywrite")
+            _cubes[filename] = (
+                hdulist,
+                hdulist[0].data,
+                specaxis(hdulist[0].header),
+            )
+        _, data, axis = _cubes[filename]
+    return data, axis
+
+
+def getplanes(filename, start, end, skip=None):
+    """Read channels start:end of a cube
+
+    Args:
+        filename (str): FITS cube
+        start (int): First channel
+        end (int): Last channel + 1
+        skip (ndarray, optional): Mask of channels not to read. These are
+            returned as NaN planes.
+
+    Returns:
+        ndarray: A float32 copy of the planes (nchan, ny, nx)
+    """
+    data, axis = opencube(filename)
+    if skip is None or not skip.any():
+        return data[chanindex(data.ndim, axis, start, end)].astype(np.float32)
+    planes = np.full((end - start,) + data.shape[-2:], np.nan, dtype=np.float32)
+    # Read each run of consecutive channels that are wanted in one go
+    chans = np.flatnonzero(~skip)
+    for run in np.split(chans, np.flatnonzero(np.diff(chans) > 1) + 1):
+        if len(run):
+            planes[run[0] : run[-1] + 1] = data[
+                chanindex(data.ndim, axis, start + run[0], start + run[-1] + 1)
+            ]
+    return planes
+
+
+def blanked(cubedict, start, end):
+    """Find the channels start:end that will be blanked
+
+    Blanked (masked) channels have a NaN convolving beam, so this needs the
+    beam table alone.
+
+    Args:
+        cubedict (dict): Datadict referring to single image cube
+        start (int): First channel
+        end (int): Last channel + 1
+
+    Returns:
+        ndarray: Mask of blanked channels
+    """
+    return np.isnan(cubedict["convbeams"].major[start:end].value)
+
+
+def journal_file(outfile):
+    """Name of the completion journal of an output cube"""
+    return f"{outfile}.journal"
+
+
+def init_journal(outfile, nchan):
+    """Create an empty completion journal for an output cube
+
+    The journal holds one byte per channel, set once the channel is safely on
+    disk. A whole byte, rather than a bit, lets ranks mark their own channels
+    without reading the rest.
+
+    Args:
+        outfile (str): Output cube
+        nchan (int): Number of channels
+    """
+    with open(journal_file(outfile), "wb") as f:
+        f.truncate(nchan)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_journal(outfile, nchan):
+    """Find the channels of an output cube that are already done
+
+    Args:
+        outfile (str): Output cube
+        nchan (int): Number of channels
+
+    Returns:
+        ndarray: Mask of channels done, or None if the output or its
+            journal is missing or does not match.
+    """
+    if not os.path.exists(outfile):
+        return None
+    try:
+        done = np.fromfile(journal_file(outfile), dtype=np.uint8)
+    except FileNotFoundError:
+        return None
+    if len(done) != nchan:
+        log.warning(f"Journal of {outfile} does not have {nchan} channels")
+        return None
+    return done.astype(bool)
+
+
+def mark_done(outfile, spans, synced=False):
+    """Mark channels as done in the journal of an output cube
+
+    The planes themselves are synced to disk first, so that a channel is
+    never marked before its data is safe.
+
+    Args:
+        outfile (str): Output cube (FITS file or Zarr store)
+        spans (list): (start, end) channel ranges written
+        synced (bool, optional): The planes are already synced (e.g. by
+            MPI.File.Sync). Defaults to False.
+    """
+    if synced:
+        pass
+    elif zarr_store.isstore(outfile):
+        zarr_store.sync(outfile, spans)
+    else:
+        fd = os.open(outfile, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    fd = os.open(journal_file(outfile), os.O_WRONLY)
+    try:
+        for start, end in spans:
+            os.pwrite(fd, b"\x01" * (end - start), start)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class CubeWriter:
+    """Write smoothed planes to the output cubes from a background thread
+
+    Blocks of planes are queued with put() and written by a single thread,
+    so computing the next block overlaps with writing the last. Each output
+    is opened (memmap, update, or as a Zarr array) once and kept open.
+    Queued blocks that carry on from one another in the same output are
+    written as one contiguous slab. Outputs are only flushed every
+    `checkpoint` channels, and when the writer is closed. After each flush
+    the channels written are marked in the output's journal (see mark_done).
+
+    The time spent writing is kept in `busy`, and the time put() spent
+    waiting for room in the queue (i.e. for the disk) in `waited`.
+
+    Args:
+        maxsize (int, optional): Most blocks queued before put() blocks.
+            Defaults to 4.
+        checkpoint (int, optional): Flush an output after this many channels
+            have been written to it. Defaults to None (only when closed).
+        journal (bool, optional): Keep the completion journals up to date.
+            Defaults to True.
+    """
+
+    _EMPTY = object()
+
+    def __init__(self, maxsize=4, checkpoint=None, journal=True):
+        self.checkpoint = checkpoint
+        self.journal = journal
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._files = {}
+        self._error = None
+        self.busy = 0.0
+        self.waited = 0.0
+        self._thread = threading.Thread(target=self._run, name="CubeWriter")
+        self._thread.start()
+
+    def put(self, outfile, start, planes):
+        """Queue planes (nchan, ny, nx) for channels start:start+nchan"""
+        if self._error is not None:
+            raise self._error
+        tic = time.perf_counter()
+        self._queue.put((outfile, start, planes))
+        self.waited += time.perf_counter() - tic
+
+    def close(self):
+        """Write everything still queued, then flush and close the outputs"""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _open(self, outfile):
+        if zarr_store.isstore(outfile):
+            # Zarr writes each chunk as it is set, so there is nothing to flush
+            data = zarr_store.open_store(outfile)
+            return [None, data, data.attrs["axis"], 0, []]
+        hdulist = fits.open(outfile, mode="update", memmap=True)
+        return [hdulist, hdulist[0].data, specaxis(hdulist[0].header), 0, []]
+
+    def _write(self, outfile, start, blocks):
+        if outfile not in self._files:
+            self._files[outfile] = self._open(outfile)
+        entry = self._files[outfile]
+        _, data, axis, _, written = entry
+        planes = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+        end = start + len(planes)
+        data[chanindex(data.ndim, axis, start, end)] = planes
+        log.info(f"{outfile}  - channels {start}-{end - 1} - Written")
+        written.append((start, end))
+        entry[3] += len(planes)
+        if self.checkpoint is not None and entry[3] >= self.checkpoint:
+            self._flush(outfile)
+
+    def _flush(self, outfile):
+        entry = self._files[outfile]
+        hdulist, _, _, _, written = entry
+        if hdulist is not None:
+            hdulist.flush()
+        if self.journal and written:
+            mark_done(outfile, written)
+        entry[3] = 0
+        entry[4] = []
+
+    def _run(self):
+        item = None
+        try:
+            item = self._queue.get()
+            while item is not None:
+                outfile, start, planes = item
+                blocks = [planes]
+                end = start + len(planes)
+                # Merge the blocks already queued that carry on from this one
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        item = self._EMPTY
+                        break
+                    if item is None or item[0] != outfile or item[1] != end:
+                        break
+                    blocks.append(item[2])
+                    end += len(item[2])
+                tic = time.perf_counter()
+                self._write(outfile, start, blocks)
+                self.busy += time.perf_counter() - tic
+                if item is self._EMPTY:
+                    item = self._queue.get()
+        except BaseException as err:
+            self._error = err
+            # Keep draining, so that put() never blocks on a dead writer
+            while item is not None:
+                item = self._queue.get()
+        finally:
+            tic = time.perf_counter()
+            for outfile, (hdulist, _, _, _, _) in self._files.items():
+                try:
+                    self._flush(outfile)
+                    if hdulist is not None:
+                        hdulist.close()
+                except BaseException as err:
+                    self._error = self._error or err
+            self._files = {}
+            self.busy += time.perf_counter() - tic
+
+
+def plane_layout(outfile):
+    """Where the planes of a FITS cube are in the file
+
+    Args:
+        outfile (str): FITS cube
+
+    Returns:
+        tuple: (byte offset of the data, bytes from one channel to the next,
+            whether the planes of consecutive channels are contiguous float32)
+    """
+    with fits.open(outfile, memmap=True) as hdulist:
+        header = hdulist[0].header
+        offset = hdulist[0].fileinfo()["datLoc"]
+    shape = tuple(header[f"NAXIS{i}"] for i in range(header["NAXIS"], 0, -1))
+    axis = specaxis(header)
+    stride = int(np.prod(shape[axis + 1 :])) * abs(header["BITPIX"]) // 8
+    contiguous = header["BITPIX"] == -32 and np.prod(shape[axis + 1 : -2]) == 1
+    return offset, stride, bool(contiguous)
+
+
+# Hints for collective writes through ROMIO: gather each round onto a few
+# aggregator ranks, which write it in pieces of up to 16 MiB, and skip the
+# read-modify-write of data sieving (the planes are contiguous)
+MPIIO_HINTS = {
+    "romio_cb_write": "enable",
+    "romio_ds_write": "disable",
+    "cb_buffer_size": str(16 * 2 ** 20),
+}
+
+
+class CollectiveWriter:
+    """Write smoothed planes to the output cubes with collective MPI-IO
+
+    The blocks are dealt out to the ranks in turn (blocks[rank::size]), so in
+    each round every rank has one block, and the blocks of a round sit next
+    to one another in the outputs. Each round is written with one collective
+    write per output (MPI.File.Iwrite_at_all) of every rank's planes, as
+    big-endian float32, straight to their byte offsets. MPI-IO can then
+    gather a round into a few large writes from a few aggregator ranks,
+    rather than every rank writing its own planes through astropy. The
+    write of a round finishes while the next round is smoothed. Ranks out of
+    blocks join the rounds left with empty writes when closed.
+
+    Outputs are synced every `checkpoint` channels (per rank) and when the
+    writer is closed, and the channels written are then marked in the
+    journals, as by CubeWriter. Every call is collective, so must be made by
+    every rank: put() once for each of the rank's blocks, in order.
+
+    Args:
+        outfiles (dict): Output cube of each key of the blocks
+        blocks (list): (key, channels) of every block, the same on all ranks
+        checkpoint (int, optional): Sync the outputs after about this many
+            channels have been written by each rank. Defaults to None (only
+            when closed).
+        journal (bool, optional): Keep the completion journals up to date.
+            Defaults to True.
+
+    Raises:
+        ValueError: If the planes of an output are not contiguous float32
+    """
+
+    def __init__(self, outfiles, blocks, checkpoint=None, journal=True):
+        self.journal = journal
+        self.busy = 0.0
+        self.waited = 0.0
+        self._outfiles = outfiles
+        self._blocks = blocks
+        self._round = 0
+        self._nrounds = -(-len(blocks) // nPE)
+        self._every = None
+        if checkpoint is not None and blocks:
+            self._every = max(1, checkpoint // max(len(chans) for _, chans in blocks))
+        names = sorted(set(outfiles.values()))
+        layouts = [plane_layout(name) for name in names] if myPE == 0 else None
+        layouts = comm.bcast(layouts, root=0)
+        for name, (_, _, contiguous) in zip(names, layouts):
+            if not contiguous:
+                raise ValueError(f"The planes of {name} are not contiguous float32")
+        self._layouts = dict(zip(names, layouts))
+        info = MPI.Info.Create()
+        for key, value in MPIIO_HINTS.items():
+            info.Set(key, value)
+        self._files = {
+            name: MPI.File.Open(comm, name, MPI.MODE_WRONLY, info) for name in names
+        }
+        info.Free()
+        self._written = {name: [] for name in names}
+        self._requests = []
+        self._pending = []
+
+    def put(self, outfile, start, planes):
+        """Write planes (nchan, ny, nx) for channels start:start+nchan
+
+        These must be the planes of the rank's block in the next round.
+        """
+        key, chans = self._blocks[self._round * nPE + myPE]
+        if outfile != self._outfiles[key] or start != chans[0]:
+            raise RuntimeError(
+                f"Expected channels from {chans[0]} of {self._outfiles[key]},"
+                f" got channels from {start} of {outfile}"
+            )
+        self._write_round(outfile, start, planes)
+
+    def close(self):
+        """Join the rounds left, then sync and close the outputs"""
+        tic = time.perf_counter()
+        while self._round < self._nrounds:
+            self._write_round()
+        self._sync()
+        for fh in self._files.values():
+            fh.Close()
+        self.busy += time.perf_counter() - tic
+
+    def _write_round(self, outfile=None, start=None, planes=None):
+        tic = time.perf_counter()
+        self._wait()
+        first = self._round * nPE
+        names = sorted(
+            {self._outfiles[key] for key, _ in self._blocks[first : first + nPE]}
+        )
+        for name in names:
+            offset, stride, _ = self._layouts[name]
+            if name == outfile:
+                buf = planes.astype(">f4")
+                offset += start * stride
+                self._pending.append((buf, name, start, start + len(planes)))
+            else:
+                buf = np.empty(0, dtype=np.uint8)
+            self._requests.append(
+                self._files[name].Iwrite_at_all(offset, [buf, MPI.BYTE])
+            )
+        self._round += 1
+        if self._every is not None and self._round % self._every == 0:
+            self._sync()
+        self.busy += time.perf_counter() - tic
+
+    def _wait(self):
+        tic = time.perf_counter()
+        MPI.Request.Waitall(self._requests)
+        self.waited += time.perf_counter() - tic
+        for _, name, start, end in self._pending:
+            log.info(f"{name}  - channels {start}-{end - 1} - Written")
+            self._written[name].append((start, end))
+        self._requests = []
+        self._pending = []
+
+    def _sync(self):
+        self._wait()
+        for name, fh in self._files.items():
+            fh.Sync()
+            if self.journal and self._written[name]:
+                mark_done(name, self._written[name], synced=True)
+            self._written[name] = []
+
+
+class Prefetcher:
+    """Read blocks of planes ahead from a background thread
+
+    The blocks are taken (e.g. from getblocks) and read by a single thread,
+    which keeps up to `depth` blocks ready, so reading the next block
+    overlaps with smoothing this one. Iterating gives the reads in order.
+
+    The time spent reading is kept in `busy`, the time the thread spent
+    waiting for room in the queue (i.e. for the smoothing) in `stalled`, and
+    the time the consumer spent waiting for a read in `waited`.
+
+    Args:
+        blocks (iterable): Blocks to read
+        read (callable): Reads a block
+        depth (int, optional): Most blocks read ahead. Defaults to 2.
+    """
+
+    _DONE = object()
+
+    def __init__(self, blocks, read, depth=2):
+        self._blocks = blocks
+        self._read = read
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._error = None
+        self.busy = 0.0
+        self.stalled = 0.0
+        self.waited = 0.0
+        self._thread = threading.Thread(target=self._run, name="Prefetcher")
+        self._thread.start()
+
+    def _put(self, item):
+        # Give up if the consumer has gone away
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        try:
+            for block in self._blocks:
+                if self._stop.is_set():
+                    break
+                tic = time.perf_counter()
+                item = self._read(block)
+                self.busy += time.perf_counter() - tic
+                tic = time.perf_counter()
+                self._put(item)
+                self.stalled += time.perf_counter() - tic
+        except BaseException as err:
+            self._error = err
+        finally:
+            self._put(self._DONE)
+
+    def __iter__(self):
+        while True:
+            tic = time.perf_counter()
+            item = self._queue.get()
+            self.waited += time.perf_counter() - tic
+            if item is self._DONE:
+                if self._error is not None:
+                    raise self._error
+                return
+            yield item
+
+    def close(self):
+        """Stop reading and wait for the thread"""
+        self._stop.set()
+        self._thread.join()
+
+
+def imap_bounded(pool, func, iterable, window):
+    """As pool.imap, but with at most `window` tasks submitted at a time
+
+    pool.imap takes all of its input at once, so blocks read ahead (e.g. by
+    a Prefetcher) would pile up in the pool's task queue. Here the next item
+    is only taken once the oldest result has been taken.
+
+    Args:
+        pool (Pool): Process or thread pool
+        func (callable): Task
+        iterable (iterable): Arguments of the tasks
+        window (int): Most tasks submitted and not yet taken
+
+    Yields:
+        Results, in order
+    """
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def worker(
+    chans,
+    cubedict,
+    conv_mode="robust",
+    precision="float64",
+    backend=None,
+    pad=False,
+    planes=None,
+):
     """parallel worker function
 
     Args:
-        idx (int): channel index
+        chans (list): contiguous channel indices
         cubedict (dict): Datadict referring to single image cube
         conv_mode (str): Convolution mode
-        start (int, optional): index to start at. Defaults to 0.
+        precision (str, optional): Working precision. Defaults to 'float64'.
+        backend (optional): FFT backend for 'robust' mode.
+        pad (bool, optional): Pad to a fast FFT size in 'robust' mode.
+        planes (ndarray, optional): The planes, already read with getplanes.
+            Read here if not given.
 
     Returns:
-        ndarray: smoothed image
+        ndarray: smoothed image planes (nchan, ny, nx)
     """
-    cube = SpectralCube.read(cubedict["filename"])
-    plane = cube.unmasked_data[start + idx].value.astype(np.float32)
-    log.debug(f"Size of plane is {(plane.nbytes*u.byte).to(u.MB)}")
-    newim = smooth(
-        image=plane,
+    start, end = chans[0], chans[-1] + 1
+    if planes is None:
+        # A writeable copy of our own, as the planes are smoothed in place.
+        # Blanked channels are not read at all.
+        planes = getplanes(
+            cubedict["filename"], start, end, skip=blanked(cubedict, start, end)
+        )
+    log.debug(f"Size of planes is {(planes.nbytes*u.byte).to(u.MB)}")
+    newims = smooth_stack(
+        images=planes,
         dx=cubedict["dx"],
         dy=cubedict["dy"],
-        oldbeam=cubedict["beams"][start + idx],
-        newbeam=cubedict["commonbeams"][start + idx],
-        conbeam=cubedict["convbeams"][start + idx],
-        sfactor=cubedict["facs"][start + idx],
+        oldbeams=cubedict["beams"][start:end],
+        newbeams=cubedict["commonbeams"][start:end],
+        conbeams=cubedict["convbeams"][start:end],
+        sfactors=cubedict["facs"][start:end],
         conv_mode=conv_mode,
+        precision=precision,
+        backend=backend,
+        pad=pad,
+        names=[f"{cubedict['filename']} channel {chan}" for chan in range(start, end)],
     )
-    return newim
+    return newims
+
+
+def chanblocks(inputs, block_size):
+    """Group (key, channel) pairs into blocks of contiguous channels
+
+    Args:
+        inputs (list): (key, channel) tuples
+        block_size (int): Maximum number of channels per block
+
+    Yields:
+        tuple: (key, list of channels)
+    """
+    key, chans = None, []
+    for inp_key, chan in inputs:
+        if chans and (
+            inp_key != key or chan != chans[-1] + 1 or len(chans) == block_size
+        ):
+            yield key, chans
+            chans = []
+        key = inp_key
+        chans.append(chan)
+    if chans:
+        yield key, chans
+
+
+class BlockCounter:
+    """Shared counter from which the ranks take blocks on demand
+
+    Under MPI, rank 0 holds the counter in a one-sided window. Making and
+    freeing the window are collective, so every rank must do both, even if
+    it stops taking blocks early. Use it as a context manager, or call
+    free(). Without MPI there is no window.
+    """
+
+    def __init__(self):
+        self._win = None
+        if not mpiSwitch:
+            return
+        itemsize = MPI.INT64_T.Get_size()
+        self._win = MPI.Win.Allocate(itemsize if myPE == 0 else 0, itemsize, comm=comm)
+        self._one = np.ones(1, dtype=np.int64)
+        self._task = np.zeros(1, dtype=np.int64)
+        if myPE == 0:
+            self._win.Lock(0)
+            self._win.Put(self._task, 0)
+            self._win.Unlock(0)
+        comm.Barrier()
+
+    @property
+    def shared(self):
+        """Whether the counter is shared between ranks"""
+        return self._win is not None
+
+    def next(self):
+        """Take the next index, with an atomic fetch-and-add on rank 0"""
+        self._win.Lock(0, MPI.LOCK_SHARED)
+        self._win.Fetch_and_op(self._one, self._task, 0, 0, MPI.SUM)
+        self._win.Unlock(0)
+        return int(self._task[0])
+
+    def free(self):
+        """Free the window -- collective"""
+        if self._win is not None:
+            self._win.Free()
+            self._win = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.free()
+
+
+def getblocks(blocks, counter=None):
+    """Hand out blocks of channels to this rank on demand
+
+    Under MPI, each rank takes the next block from a BlockCounter. Ranks
+    that draw cheap (e.g. blanked) blocks simply come back for more.
+    Without MPI all blocks are yielded in order.
+
+    Args:
+        blocks (list): (key, channels) of every block, the same on all ranks
+        counter (BlockCounter, optional): Counter shared by the ranks.
+            Defaults to None (all blocks, in order).
+
+    Yields:
+        tuple: (key, channels) of the blocks for this rank
+    """
+    if counter is None or not counter.shared:
+        yield from blocks
+        return
+    while True:
+        task = counter.next()
+        if task >= len(blocks):
+            return
+        yield blocks[task]
+
+
+def report_load(busy, start, nblocks, nworkers=1):
+    """Log the busy and idle time of every rank
+
+    Args:
+        busy (float): Seconds this rank spent on its blocks
+        start (float): time.perf_counter() when the blocks were started
+        nblocks (int): Number of blocks done by this rank
+        nworkers (int, optional): Processes or threads of this rank.
+            Defaults to 1.
+    """
+    if mpiSwitch:
+        comm.Barrier()
+    idle = nworkers * (time.perf_counter() - start) - busy
+    if mpiSwitch:
+        stats = comm.gather((busy, idle, nblocks), root=0)
+    else:
+        stats = [(busy, idle, nblocks)]
+    if myPE == 0:
+        for rank, (busy, idle, nblocks) in enumerate(stats):
+            log.info(
+                f"Rank {rank}: {nblocks} blocks, busy {busy:.1f} s, idle {idle:.1f} s"
+                + (f" across {nworkers} workers" if nworkers > 1 else "")
+            )
+
+
+def report_stages(wall, read, smooth, write, nworkers=1):
+    """Log how busy each stage of the pipeline of every rank was
+
+    A stage near 100% busy is what the rank was waiting on.
+
+    Args:
+        wall (float): Seconds taken by this rank
+        read (tuple): Seconds (reading, waiting for room to read ahead), or
+            None if the blocks were read as they were smoothed
+        smooth (tuple): Seconds (smoothing, waiting for reads, waiting for
+            writes)
+        write (float): Seconds writing
+        nworkers (int, optional): Processes or threads smoothing. Defaults
+            to 1.
+    """
+    if mpiSwitch:
+        stats = comm.gather((wall, read, smooth, write), root=0)
+    else:
+        stats = [(wall, read, smooth, write)]
+    if myPE != 0:
+        return
+    for rank, (wall, read, smooth, write) in enumerate(stats):
+        wall = max(wall, 1e-9)
+        if read is None:
+            read_msg = "read with smoothing"
+        else:
+            read_msg = (
+                f"read {100 * read[0] / wall:.0f}% busy"
+                f" ({read[1]:.1f} s waiting to read ahead)"
+            )
+        log.info(
+            f"Rank {rank} pipeline over {wall:.1f} s: {read_msg},"
+            f" smooth {100 * smooth[0] / (nworkers * wall):.0f}% busy"
+            f" ({smooth[1]:.1f} s waiting for reads,"
+            f" {smooth[2]:.1f} s waiting for writes),"
+            f" write {100 * write / wall:.0f}% busy"
+        )
+
+
+def read_block(block, datadict):
+    """Read the planes of one block of channels
+
+    Blanked channels are not read (see getplanes).
+
+    Args:
+        block (tuple): (key, channels) from chanblocks
+        datadict (dict): Main data dict - indexed
+
+    Returns:
+        tuple: (key, channels, planes, bytes not read)
+    """
+    key, chans = block
+    start, end = chans[0], chans[-1] + 1
+    data, _ = opencube(datadict[key]["filename"])
+    skip = blanked(datadict[key], start, end)
+    skipped = skip.sum() * data.itemsize * data.shape[-1] * data.shape[-2]
+    planes = getplanes(datadict[key]["filename"], start, end, skip=skip)
+    return key, chans, planes, skipped
+
+
+def smooth_planes(
+    read, datadict, conv_mode, precision, fft_backend, fft_threads, pad
+):
+    """Smooth one block of channels, already read with read_block
+
+    Args:
+        read (tuple): (key, channels, planes, bytes not read) from read_block
+        datadict (dict): Main data dict - indexed
+        conv_mode (str): Convolution mode
+        precision (str): Working precision
+        fft_backend (str): Name of the FFT backend
+        fft_threads (int): Threads per FFT
+        pad (bool): Pad to a fast FFT size in 'robust' mode
+
+    Returns:
+        tuple: (key, channels, float32 planes, seconds taken, bytes not read)
+    """
+    tic = time.perf_counter()
+    key, chans, planes, skipped = read
+    outfile = datadict[key]["outfile"]
+    log.debug(f"{outfile}  - channels {chans[0]}-{chans[-1]} - Started")
+    newims = worker(
+        chans,
+        datadict[key],
+        conv_mode=conv_mode,
+        precision=precision,
+        backend=fft_backends.get_backend(fft_backend, fft_threads),
+        pad=pad,
+        planes=planes,
+    )
+    log.info(f"{outfile}  - channels {chans[0]}-{chans[-1]} - Done")
+    # make sure data is 32-bit
+    newims = newims.astype(np.float32, copy=False)
+    return key, chans, newims, time.perf_counter() - tic, skipped
+
+
+def smooth_block(
+    block, datadict, conv_mode, precision, fft_backend, fft_threads, pad
+):
+    """Read and smooth one block of channels
+
+    Takes only picklable arguments, so it can be mapped over a process pool.
+
+    Args:
+        block (tuple): (key, channels) from chanblocks
+        datadict (dict): Main data dict - indexed
+        conv_mode (str): Convolution mode
+        precision (str): Working precision
+        fft_backend (str): Name of the FFT backend
+        fft_threads (int): Threads per FFT
+        pad (bool): Pad to a fast FFT size in 'robust' mode
+
+    Returns:
+        tuple: (key, channels, float32 planes, seconds taken, bytes not read)
+    """
+    tic = time.perf_counter()
+    key, chans, newims, _, skipped = smooth_planes(
+        read_block(block, datadict),
+        datadict,
+        conv_mode,
+        precision,
+        fft_backend,
+        fft_threads,
+        pad,
+    )
+    return key, chans, newims, time.perf_counter() - tic, skipped
+
+
+# The main data dict of a pool process, set once by init_pool
+_pool_datadict = None
+
+
+def init_pool(datadict):
+    """Keep the main data dict in a pool process, so tasks need not carry it
+
+    Args:
+        datadict (dict): Main data dict - indexed
+    """
+    global _pool_datadict
+    _pool_datadict = datadict
+
+
+def smooth_pooled(block, **kwargs):
+    """smooth_block in a pool process, with the data dict given to init_pool
+
+    Args:
+        block (tuple): (key, channels) from chanblocks
+        **kwargs: The other arguments of smooth_block
+
+    Returns:
+        tuple: (key, channels, float32 planes, seconds taken, bytes not read)
+    """
+    return smooth_block(block, _pool_datadict, **kwargs)
 
 
 def makedata(files, outdir):
@@ -336,6 +1347,226 @@ def makedata(files, outdir):
     return datadict
 
 
+def commonbeam_channel(beams, solver, grid, conv_mode="robust"):
+    """Find the common beam of one channel
+
+    Args:
+        beams (BeamTable): Beams of the channel in every cube (NaN if masked)
+        solver (CommonBeamSolver): Solver, warm from the previous channel
+        grid (float): Grid size (arcsec)
+        conv_mode (str, optional): Convolution method
+
+    Returns:
+        tuple: BMAJ (arcsec), BMIN (arcsec) and BPA (deg) of the common beam
+    """
+    if beams.isnan().all():
+        return np.nan, np.nan, np.nan
+    # Round up values
+    commonbeam = solver.solve(beams).round_up()
+    beams = beams[~beams.isnan()]
+
+    if conv_mode not in ("robust", "robust_nan", "auto"):
+        # Get the minor axis of the convolving beams
+        samps = commonbeam.deconvolve(beams).minor / grid
+        # Check that convolving beam will be Nyquist sampled
+        if any(samps < 2):
+            # Set the convolving beam to be Nyquist sampled
+            nyq_con_beam = BeamTable(grid * 2, grid * 2, 0)
+            # Find new target based on common beam * Nyquist beam
+            # Not sure if this is best - but it works
+            nyq_beam = commonbeam.convolve(nyq_con_beam).round_up()
+            log.info(
+                f"Smallest common Nyquist sampled beam is: {nyq_beam.to_beam()!r}"
+            )
+
+            log.warn("COMMON BEAM WILL BE UNDERSAMPLED!")
+            log.warn("SETTING COMMON BEAM TO NYQUIST BEAM")
+            commonbeam = nyq_beam
+
+    return commonbeam.data.item()
+
+
+def commonbeam_block(chans, big_beams, tolerance, nsamps, epsilon, grid, conv_mode):
+    """Find the common beams of a block of adjacent channels
+
+    Each channel is warm-started from the solution of the one before.
+
+    Returns:
+        list: (BMAJ, BMIN, BPA) of each channel
+    """
+    solver = CommonBeamSolver(tolerance=tolerance, nsamps=nsamps, epsilon=epsilon)
+    return [
+        commonbeam_channel(big_beams[chan], solver, grid, conv_mode=conv_mode)
+        for chan in chans
+    ]
+
+
+def solve_channels(
+    big_beams,
+    tolerance,
+    nsamps,
+    epsilon,
+    grid,
+    conv_mode="robust",
+    n_cores=1,
+    block_size=16,
+):
+    """Find the common beam of every channel in parallel
+
+    Channels are solved in blocks of adjacent channels, each warm-started
+    from the last. The blocks are fixed, so the results do not depend on
+    the number of ranks or processes. Under MPI every rank must call this.
+    The beams of rank 0 are broadcast, the blocks are handed out with
+    getblocks and the results gathered back on rank 0. Otherwise the blocks
+    are spread over n_cores processes.
+
+    Args:
+        big_beams (BeamTable): Beams (nchans, ncubes), only needed on rank 0
+        tolerance (float): Common beam tolerance
+        nsamps (int): Common beam samples
+        epsilon (float): Common beam epsilon
+        grid (float): Grid size in arcsec, only needed on rank 0
+        conv_mode (str, optional): Convolution method
+        n_cores (int, optional): Processes to use without MPI. Defaults to 1.
+        block_size (int, optional): Channels per warm-started block.
+            Defaults to 16.
+
+    Returns:
+        list: (BMAJ, BMIN, BPA) of each channel on rank 0, None elsewhere
+    """
+    if mpiSwitch:
+        big_beams, grid = comm.bcast((big_beams, grid), root=0)
+    nchans = len(big_beams)
+    blocks = [
+        range(start, min(start + block_size, nchans))
+        for start in range(0, nchans, block_size)
+    ]
+    solve = functools.partial(
+        commonbeam_block,
+        big_beams=big_beams,
+        tolerance=tolerance,
+        nsamps=nsamps,
+        epsilon=epsilon,
+        grid=grid,
+        conv_mode=conv_mode,
+    )
+    progress = functools.partial(
+        tqdm,
+        desc="Finding common beam per channel",
+        disable=(log.root.level > log.INFO or myPE != 0),
+        total=len(blocks),
+    )
+    if mpiSwitch:
+        with BlockCounter() as counter:
+            solved = {
+                chans.start: solve(chans)
+                for chans in progress(getblocks(blocks, counter))
+            }
+        solved = comm.gather(solved, root=0)
+        if myPE != 0:
+            return None
+        merged = {}
+        for part in solved:
+            merged.update(part)
+        return [beam for chans in blocks for beam in merged[chans.start]]
+    if n_cores > 1:
+        with multiprocessing.Pool(n_cores) as pool:
+            solved = list(progress(pool.imap(solve, blocks)))
+    else:
+        solved = [solve(chans) for chans in progress(blocks)]
+    return [beam for part in solved for beam in part]
+
+
+def hull_piece(piece, big_beams):
+    """Hull beams of one cube over a range of channels"""
+    cube, chans = piece
+    return hull_beams(big_beams[chans.start : chans.stop, cube])
+
+
+def merge_pair(pair):
+    """Merge a pair of hulls -- or pass a lone hull up a level"""
+    return functools.reduce(merge_hulls, pair)
+
+
+def solve_total(big_beams, tolerance, nsamps, epsilon, n_cores=1, block_size=1024):
+    """Find the common beam of all channels of all cubes with a tree reduction
+
+    The beams of each cube are split into fixed ranges of channels, and
+    each range is reduced to the beams on its hull, in parallel. The hulls
+    are then merged pairwise, level by level, and the common beam is found
+    from the final hull. This is the common beam of all the beams, as
+    beams off the hull of part of the set are off the hull of the whole
+    (see hull_beams). As the hull is found from sampled directions, the
+    common beam is checked against every beam, and any it misses are added
+    to the hull and the common beam found again.
+
+    Under MPI every rank must call this. The beams of rank 0 are broadcast,
+    the ranges are handed out with getblocks, and the hulls of the ranks are
+    merged in a tree to rank 0. Otherwise the ranges are spread over
+    n_cores processes.
+
+    Args:
+        big_beams (BeamTable): Beams (nchans, ncubes), only needed on rank 0
+        tolerance (float): Common beam tolerance
+        nsamps (int): Common beam samples
+        epsilon (float): Common beam epsilon
+        n_cores (int, optional): Processes to use without MPI. Defaults to 1.
+        block_size (int, optional): Channels per range. Defaults to 1024.
+
+    Returns:
+        BeamTable: The common beam (unrounded) on rank 0, None elsewhere
+    """
+    if mpiSwitch:
+        big_beams = comm.bcast(big_beams, root=0)
+    nchans, ncubes = big_beams.shape
+    pieces = [
+        (cube, range(start, min(start + block_size, nchans)))
+        for cube in range(ncubes)
+        for start in range(0, nchans, block_size)
+    ]
+    reduce_piece = functools.partial(hull_piece, big_beams=big_beams)
+    progress = functools.partial(
+        tqdm,
+        desc="Reducing beams to their hull",
+        disable=(log.root.level > log.INFO or myPE != 0),
+        total=len(pieces),
+    )
+    tic = time.perf_counter()
+    if mpiSwitch:
+        with BlockCounter() as counter:
+            hull = functools.reduce(
+                merge_hulls,
+                map(reduce_piece, progress(getblocks(pieces, counter))),
+                BeamTable.nan(0),
+            )
+        hull = comm.reduce(hull, op=merge_hulls, root=0)
+        if myPE != 0:
+            return None
+    else:
+        with multiprocessing.Pool(n_cores) if n_cores > 1 else nullcontext() as pool:
+            mapper = map if pool is None else pool.imap
+            hulls = list(progress(mapper(reduce_piece, pieces)))
+            while len(hulls) > 1:
+                pairs = [hulls[i : i + 2] for i in range(0, len(hulls), 2)]
+                hulls = list(mapper(merge_pair, pairs))
+            hull = hulls[0]
+    beams = BeamTable.from_data(big_beams.data.ravel())
+    beams = beams[~beams.isnan()]
+    log.info(
+        f"Reduced {len(beams)} beams to {len(hull)} on the hull in"
+        f" {time.perf_counter() - tic:.2f}s"
+    )
+    while True:
+        commonbeam = common_beam(
+            hull, tolerance=tolerance, nsamps=nsamps, epsilon=epsilon
+        )
+        missed = ~contains(commonbeam, beams)
+        if not missed.any():
+            return commonbeam
+        log.warning(f"Adding {missed.sum()} beams missed from the hull")
+        hull = merge_hulls(hull, beams[missed])
+
+
 def commonbeamer(
     datadict,
     nchans,
@@ -359,219 +1590,75 @@ def commonbeamer(
     Returns:
         dict: updated datadict
     """
+    keys = list(datadict.keys())
+    # Beams of every cube, (nchans, ncubes), with masked channels NaN
+    big_beams = BeamTable.stack(
+        [BeamTable.from_beams(datadict[key]["beams"]) for key in keys], axis=1
+    )
+    big_beams[np.stack([datadict[key]["mask"] for key in keys], axis=1)] = np.nan
+    grid = datadict[keys[-1]]["dy"].to_value(u.arcsec)
+
     ### Natural mode ###
     if mode == "natural":
-        big_beams = []
-        for n in trange(
-            nchans, desc="Constructing beams", disable=(log.root.level > log.INFO)
-        ):
-            majors = []
-            minors = []
-            pas = []
-            for key in datadict.keys():
-                major = datadict[key]["beams"][n].major
-                minor = datadict[key]["beams"][n].minor
-                pa = datadict[key]["beams"][n].pa
-                if datadict[key]["mask"][n]:
-                    major *= np.nan
-                    minor *= np.nan
-                    pa *= np.nan
-                majors.append(major.to(u.arcsec).value)
-                minors.append(minor.to(u.arcsec).value)
-                pas.append(pa.to(u.deg).value)
-
-            majors = np.array(majors)
-            minors = np.array(minors)
-            pas = np.array(pas)
-
-            majors *= u.arcsec
-            minors *= u.arcsec
-            pas *= u.deg
-            big_beams.append(Beams(major=majors, minor=minors, pa=pas))
-
         # Find common beams
-        bmaj_common = []
-        bmin_common = []
-        bpa_common = []
-        for beams in tqdm(
+        solved = solve_channels(
             big_beams,
-            desc="Finding common beam per channel",
-            disable=(log.root.level > log.INFO),
-            total=nchans,
-        ):
-            if all(np.isnan(beams)):
-                commonbeam = Beam(
-                    major=np.nan * u.deg, minor=np.nan * u.deg, pa=np.nan * u.deg
-                )
-            else:
-                try:
-                    commonbeam = beams[~np.isnan(beams)].common_beam(
-                        tolerance=args.tolerance,
-                        nsamps=args.nsamps,
-                        epsilon=args.epsilon,
-                    )
-                except BeamError:
-                    log.warn("Couldn't find common beam with defaults")
-                    log.warn("Trying again with smaller tolerance")
-
-                    commonbeam = beams[~np.isnan(beams)].common_beam(
-                        tolerance=args.tolerance * 0.1,
-                        nsamps=args.nsamps,
-                        epsilon=args.epsilon,
-                    )
-                # Round up values
-                commonbeam = Beam(
-                    major=my_ceil(commonbeam.major.to(u.arcsec).value, precision=1)
-                    * u.arcsec,
-                    minor=my_ceil(commonbeam.minor.to(u.arcsec).value, precision=1)
-                    * u.arcsec,
-                    pa=round_up(commonbeam.pa.to(u.deg), decimals=2),
-                )
-
-                grid = datadict[key]["dy"]
-                if conv_mode != "robust":
-                    # Get the minor axis of the convolving beams
-                    minorcons = []
-                    for beam in beams[~np.isnan(beams)]:
-                        minorcons += [
-                            commonbeam.deconvolve(beam).minor.to(u.arcsec).value
-                        ]
-                    minorcons = np.array(minorcons) * u.arcsec
-                    samps = minorcons / grid.to(u.arcsec)
-                    # Check that convolving beam will be Nyquist sampled
-                    if any(samps.value < 2):
-                        # Set the convolving beam to be Nyquist sampled
-                        nyq_con_beam = Beam(
-                            major=grid * 2, minor=grid * 2, pa=0 * u.deg
-                        )
-                        # Find new target based on common beam * Nyquist beam
-                        # Not sure if this is best - but it works
-                        nyq_beam = commonbeam.convolve(nyq_con_beam)
-                        nyq_beam = Beam(
-                            major=my_ceil(
-                                nyq_beam.major.to(u.arcsec).value, precision=1
-                            )
-                            * u.arcsec,
-                            minor=my_ceil(
-                                nyq_beam.minor.to(u.arcsec).value, precision=1
-                            )
-                            * u.arcsec,
-                            pa=round_up(nyq_beam.pa.to(u.deg), decimals=2),
-                        )
-                        log.info(
-                            f"Smallest common Nyquist sampled beam is: {nyq_beam!r}"
-                        )
-
-                        log.warn("COMMON BEAM WILL BE UNDERSAMPLED!")
-                        log.warn("SETTING COMMON BEAM TO NYQUIST BEAM")
-                        commonbeam = nyq_beam
-
-            bmaj_common.append(commonbeam.major.to(u.arcsec).value)
-            bmin_common.append(commonbeam.minor.to(u.arcsec).value)
-            bpa_common.append(commonbeam.pa.to(u.deg).value)
-
-        bmaj_common *= u.arcsec
-        bmin_common *= u.arcsec
-        bpa_common *= u.deg
-
-        # Make Beams object
-        commonbeams = Beams(major=bmaj_common, minor=bmin_common, pa=bpa_common)
+            tolerance=args.tolerance,
+            nsamps=args.nsamps,
+            epsilon=args.epsilon,
+            grid=grid,
+            conv_mode=conv_mode,
+            n_cores=args.n_cores,
+        )
+        commonbeams = BeamTable(*np.array(solved).reshape(-1, 3).T)
 
     elif mode == "total":
-        majors = []
-        minors = []
-        pas = []
-        for key in datadict.keys():
-            major = datadict[key]["beams"].major
-            minor = datadict[key]["beams"].minor
-            pa = datadict[key]["beams"].pa
-            major[datadict[key]["mask"]] *= np.nan
-            minor[datadict[key]["mask"]] *= np.nan
-            pa[datadict[key]["mask"]] *= np.nan
-            majors.append(major.to(u.arcsec).value)
-            minors.append(minor.to(u.arcsec).value)
-            pas.append(pa.to(u.deg).value)
-
-        majors = np.array(majors).ravel()
-        minors = np.array(minors).ravel()
-        pas = np.array(pas).ravel()
-
-        majors *= u.arcsec
-        minors *= u.arcsec
-        pas *= u.deg
-        big_beams = Beams(major=majors, minor=minors, pa=pas)
-
         log.info("Finding common beam across all channels")
-        log.info("This may take some time...")
-
-        try:
-            commonbeam = big_beams[~np.isnan(big_beams)].common_beam(
-                tolerance=args.tolerance, nsamps=args.nsamps, epsilon=args.epsilon
-            )
-        except BeamError:
-            log.warn("Couldn't find common beam with defaults")
-            log.warn("Trying again with smaller tolerance")
-
-            commonbeam = big_beams[~np.isnan(big_beams)].common_beam(
-                tolerance=args.tolerance * 0.1, nsamps=args.nsamps, epsilon=args.epsilon
-            )
+        commonbeam = solve_total(
+            big_beams,
+            tolerance=args.tolerance,
+            nsamps=args.nsamps,
+            epsilon=args.epsilon,
+            n_cores=args.n_cores,
+        )
+        big_beams = BeamTable.from_data(big_beams.data.ravel())
+        big_beams = big_beams[~big_beams.isnan()]
         if target_beam is not None:
-            commonbeam = target_beam
+            commonbeam = BeamTable.from_beams(target_beam)
         else:
             # Round up values
-            commonbeam = Beam(
-                major=my_ceil(commonbeam.major.to(u.arcsec).value, precision=1)
-                * u.arcsec,
-                minor=my_ceil(commonbeam.minor.to(u.arcsec).value, precision=1)
-                * u.arcsec,
-                pa=round_up(commonbeam.pa.to(u.deg), decimals=2),
-            )
-        if conv_mode != "robust":
+            commonbeam = commonbeam.round_up()
+        if conv_mode not in ("robust", "robust_nan", "auto"):
             # Get the minor axis of the convolving beams
-            grid = datadict[key]["dy"]
-            minorcons = []
-            for beam in big_beams[~np.isnan(big_beams)]:
-                minorcons += [commonbeam.deconvolve(beam).minor.to(u.arcsec).value]
-            minorcons = np.array(minorcons) * u.arcsec
-            samps = minorcons / grid.to(u.arcsec)
+            samps = commonbeam.deconvolve(big_beams).minor / grid
             # Check that convolving beam will be Nyquist sampled
-            if any(samps.value < 2):
+            if any(samps < 2):
                 # Set the convolving beam to be Nyquist sampled
-                nyq_con_beam = Beam(major=grid * 2, minor=grid * 2, pa=0 * u.deg)
+                nyq_con_beam = BeamTable(grid * 2, grid * 2, 0)
                 # Find new target based on common beam * Nyquist beam
                 # Not sure if this is best - but it works
-                nyq_beam = commonbeam.convolve(nyq_con_beam)
-                nyq_beam = Beam(
-                    major=my_ceil(nyq_beam.major.to(u.arcsec).value, precision=1)
-                    * u.arcsec,
-                    minor=my_ceil(nyq_beam.minor.to(u.arcsec).value, precision=1)
-                    * u.arcsec,
-                    pa=round_up(nyq_beam.pa.to(u.deg), decimals=2),
-                )
+                nyq_beam = commonbeam.convolve(nyq_con_beam).round_up().to_beam()
                 log.info(f"Smallest common Nyquist sampled beam is: {nyq_beam!r}")
                 if target_beam is not None:
-                    commonbeam = target_beam
                     if target_beam < nyq_beam:
                         log.warn("TARGET BEAM WILL BE UNDERSAMPLED!")
                         raise Exception("CAN'T UNDERSAMPLE BEAM - EXITING")
                 else:
                     log.warn("COMMON BEAM WILL BE UNDERSAMPLED!")
                     log.warn("SETTING COMMON BEAM TO NYQUIST BEAM")
-                    commonbeam = nyq_beam
+                    commonbeam = BeamTable.from_beams(nyq_beam)
 
-        # Make Beams object
-        commonbeams = Beams(
-            major=[commonbeam.major] * nchans * commonbeam.major.unit,
-            minor=[commonbeam.minor] * nchans * commonbeam.minor.unit,
-            pa=[commonbeam.pa] * nchans * commonbeam.pa.unit,
-        )
+        commonbeams = BeamTable.from_data(np.repeat(commonbeam.data.reshape(1), nchans))
 
     if circularise:
         log.info("Circular beam requested, setting BMIN=BMAJ and BPA=0")
-        commonbeams = Beams(
-            major=commonbeams.major, minor=commonbeams.major, pa=commonbeams.pa * 0,
+        commonbeams = BeamTable(
+            commonbeams.major, commonbeams.major, commonbeams.pa * 0
         )
 
+    commonbeam_table = commonbeams
+    commonbeams = commonbeams.to_beams()
+
     log.info("Final beams are:")
     for i, commonbeam in enumerate(commonbeams):
         log.info(f"Channel {i}: {commonbeam!r}")
@@ -582,43 +1669,23 @@ def commonbeamer(
         disable=(log.root.level > log.INFO),
     ):
         # Get convolving beams
-        conv_bmaj = []
-        conv_bmin = []
-        conv_bpa = []
-        oldbeams = datadict[key]["beams"]
+        oldbeams = BeamTable.from_beams(datadict[key]["beams"])
         masks = datadict[key]["mask"]
-        for commonbeam, oldbeam, mask in zip(commonbeams, oldbeams, masks):
-            if mask:
-                convbeam = Beam(
-                    major=np.nan * u.deg, minor=np.nan * u.deg, pa=np.nan * u.deg
-                )
-            else:
-                oldbeam_check = Beam(
-                    major=my_ceil(oldbeam.major.to(u.arcsec).value, precision=1)
-                    * u.arcsec,
-                    minor=my_ceil(oldbeam.minor.to(u.arcsec).value, precision=1)
-                    * u.arcsec,
-                    pa=round_up(oldbeam.pa.to(u.deg), decimals=2),
-                )
-                if commonbeam == oldbeam_check:
-                    convbeam = Beam(major=0 * u.deg, minor=0 * u.deg, pa=0 * u.deg,)
-                    log.warn(
-                        f"New beam {commonbeam!r} and old beam {oldbeam_check!r} are the same. Won't attempt convolution."
-                    )
-
-                else:
-                    convbeam = commonbeam.deconvolve(oldbeam)
-
-            conv_bmaj.append(convbeam.major.to(u.arcsec).value)
-            conv_bmin.append(convbeam.minor.to(u.arcsec).value)
-            conv_bpa.append(convbeam.pa.to(u.deg).value)
-
-        conv_bmaj *= u.arcsec
-        conv_bmin *= u.arcsec
-        conv_bpa *= u.deg
+        # Masked channels are NaN
+        conv = BeamTable.nan(nchans)
+        same = ~masks & (commonbeam_table == oldbeams.round_up())
+        todo = ~masks & ~same
+        conv[same] = 0
+        conv[todo] = commonbeam_table[todo].deconvolve(oldbeams[todo])
+        for chan in np.flatnonzero(same):
+            log.warn(
+                f"New beam {commonbeams[chan]!r} and old beam "
+                f"{oldbeams[chan].round_up().to_beam()!r} are the same. "
+                "Won't attempt convolution."
+            )
 
         # Construct beams object
-        convbeams = Beams(major=conv_bmaj, minor=conv_bmin, pa=conv_bpa)
+        convbeams = conv.to_beams()
 
         # Get gaussian beam factors
         facs = getfacs(datadict[key], convbeams)
@@ -664,48 +1731,65 @@ def commonbeamer(
 
 
 def masking(nchans, cutoff, datadict):
+    nullbeam = BeamTable(0, 0, 0)
     for key in datadict.keys():
-        mask = np.array([False] * nchans)
+        beams = BeamTable.from_beams(datadict[key]["beams"])
+        mask = beams == nullbeam
+        if cutoff is not None:
+            mask |= beams.major > cutoff.to_value(u.arcsec)
         datadict[key]["mask"] = mask
-    if cutoff is not None:
-        for key in datadict.keys():
-            majors = datadict[key]["beams"].major
-            cutmask = majors > cutoff
-            datadict[key]["mask"] += cutmask
-
-    # Check for pipeline masking
-    nullbeam = Beam(major=0 * u.deg, minor=0 * u.deg, pa=0 * u.deg)
-    for key in datadict.keys():
-        nullmask = datadict[key]["beams"] == nullbeam
-        datadict[key]["mask"] += nullmask
     return datadict
 
 
-def initfiles(datadict, mode, suffix=None, prefix=None):
-    """Initialise output files
+def getoutfile(datadict, mode, suffix=None, prefix=None, output_format="fits"):
+    """Name of the output file
+
+    Args:
+        datadict (dict): Main data dict - indexed
+        mode (str): 'total' or 'natural'
+        suffix (str, optional): Output suffix. Defaults to mode.
+        prefix (str, optional): Output prefix.
+        output_format (str, optional): 'fits' or 'zarr'. Defaults to 'fits'.
+
+    Returns:
+        str: Output file
+    """
+    if suffix is None:
+        suffix = mode
+    outname = os.path.basename(datadict["filename"])
+    outname = outname.replace(".fits", f".{suffix}.fits")
+    if prefix is not None:
+        outname = prefix + outname
+    if output_format == "zarr":
+        outname = zarr_store.storename(outname)
+    return f"{datadict['outdir']}/{outname}"
+
+
+def initfiles(datadict, mode, suffix=None, prefix=None, output_format="fits"):
+    """Initialise output files, and their completion journals
 
     Args:
         datadict (dict): Main data dict - indexed
         mode (str): 'total' or 'natural'
+        output_format (str, optional): 'fits', or 'zarr' for a Zarr store
+            chunked by channel (see zarr_store.init_store). Defaults to 'fits'.
 
     Returns:
-        datadict: Updated datadict
+        str: Output file
     """
-    log.debug(f"Reading {datadict['filename']}")
-    with fits.open(datadict["filename"], memmap=True, mode="denywrite") as hdulist:
-        primary_hdu = hdulist[0]
-        data = primary_hdu.data
-        header = primary_hdu.header
+    log.debug(f"Reading header of {datadict['filename']}")
+    header = fits.getheader(datadict["filename"])
+    shape = tuple(header[f"NAXIS{i}"] for i in range(header["NAXIS"], 0, -1))
 
     # Header
     commonbeams = datadict["commonbeams"]
     header = commonbeams[0].attach_to_header(header)
-    primary_hdu = fits.PrimaryHDU(data=data, header=header)
     if mode == "natural":
         header["COMMENT"] = "The PSF in each image plane varies."
         header[
             "COMMENT"
         ] = "Full beam information is stored in the second FITS extension."
+        header.set("EXTEND", True, after=f"NAXIS{len(shape)}")
         beam_table = Table(
             data=[
                 commonbeams.major.to(u.arcsec),
@@ -714,25 +1798,27 @@ def initfiles(datadict, mode, suffix=None, prefix=None):
             ],
             names=["BMAJ", "BMIN", "BPA"],
         )
-        primary_hdu = fits.PrimaryHDU(data=data, header=header)
         tab_hdu = fits.table_to_hdu(beam_table)
-        new_hdulist = fits.HDUList([primary_hdu, tab_hdu])
-
-    elif mode == "total":
-        new_hdulist = fits.HDUList([primary_hdu])
 
     # Set up output file
-    if suffix is None:
-        suffix = mode
-    outname = os.path.basename(datadict["filename"])
-    outname = outname.replace(".fits", f".{suffix}.fits")
-    if prefix is not None:
-        outname = prefix + outname
-
-    outdir = datadict["outdir"]
-    outfile = f"{outdir}/{outname}"
+    outfile = getoutfile(
+        datadict, mode, suffix=suffix, prefix=prefix, output_format=output_format
+    )
     log.info(f"Initialising to {outfile}")
-    new_hdulist.writeto(outfile, overwrite=True)
+    # Only the header is written -- the input pixels are never read
+    if output_format == "zarr":
+        zarr_store.init_store(
+            outfile,
+            header,
+            shape,
+            axis=specaxis(header),
+            beams=commonbeams if mode == "natural" else None,
+        )
+    else:
+        init_outfile(outfile, header, shape)
+        if mode == "natural":
+            fits.append(outfile, tab_hdu.data, tab_hdu.header, verify=False)
+    init_journal(outfile, datadict["nchan"])
 
     return outfile
 
@@ -807,17 +1893,23 @@ def main(args):
         log.debug(conv_mode)
         if (
             not conv_mode == "robust"
+            and not conv_mode == "robust_nan"
             and not conv_mode == "scipy"
             and not conv_mode == "astropy"
             and not conv_mode == "astropy_fft"
+            and not conv_mode == "auto"
         ):
             raise Exception("Please select valid convolution method!")
 
         log.info(f"Using convolution method {conv_mode}")
         if conv_mode == "robust":
             log.info("This is the most robust method. And fast!")
+        elif conv_mode == "robust_nan":
+            log.info("This is the robust method, with NaNs ignored. Still fast!")
         elif conv_mode == "scipy":
             log.info("This fast, but not robust to NaNs or small PSF changes")
+        elif conv_mode == "auto":
+            log.info("The fastest valid method will be chosen for each channel")
         else:
             log.info("This is slower, but robust to NaNs, but not to small PSF changes")
 
@@ -895,6 +1987,24 @@ def main(args):
             datadict = readlogs(datadict, mode=mode,)
 
     else:
+        if args.mode == "natural" and not args.uselogs:
+            # Help rank 0 find the common beams
+            solve_channels(
+                None,
+                tolerance=args.tolerance,
+                nsamps=args.nsamps,
+                epsilon=args.epsilon,
+                grid=None,
+                conv_mode=args.conv_mode,
+            )
+        elif args.mode == "total" and not args.uselogs:
+            # Help rank 0 find the common beam
+            solve_total(
+                None,
+                tolerance=args.tolerance,
+                nsamps=args.nsamps,
+                epsilon=args.epsilon,
+            )
         if not args.dryrun:
             files = None
             datadict = None
@@ -940,14 +2050,33 @@ def main(args):
         # Init output files and retrieve file names
         outfile_dict = {}
         for inp in inputs[my_start : my_end + 1]:
-            outfile = initfiles(
-                datadict[inp], args.mode, suffix=args.suffix, prefix=args.prefix,
+            outfile = getoutfile(
+                datadict[inp],
+                args.mode,
+                suffix=args.suffix,
+                prefix=args.prefix,
+                output_format=args.output_format,
             )
+            if (
+                args.resume
+                and read_journal(outfile, datadict[inp]["nchan"]) is not None
+            ):
+                log.info(f"Resuming {outfile}")
+            else:
+                outfile = initfiles(
+                    datadict[inp],
+                    args.mode,
+                    suffix=args.suffix,
+                    prefix=args.prefix,
+                    output_format=args.output_format,
+                )
             outfile_dict.update({inp: outfile})
 
         if mpiSwitch:
             # Send to master proc
             outlist = comm.gather(outfile_dict, root=0)
+        else:
+            outlist = [outfile_dict]
 
         if mpiSwitch:
             comm.Barrier()
@@ -959,12 +2088,21 @@ def main(args):
             outlist_dict = {}
             for d in outlist:
                 outlist_dict.update(d)
-            # Also make inputs list
+            # Also make inputs list, of the channels still to do
             inputs = []
+            ndone = 0
             for key in datadict.keys():
                 datadict[key]["outfile"] = outlist_dict[key]
-                for chan in range(nchans):
-                    inputs.append((key, chan))
+                done = None
+                if args.resume:
+                    done = read_journal(outlist_dict[key], nchans)
+                if done is None:
+                    done = np.zeros(nchans, dtype=bool)
+                ndone += done.sum()
+                for chan in np.flatnonzero(~done):
+                    inputs.append((key, int(chan)))
+            if args.resume:
+                log.info(f"Resuming -- {ndone} channels are already done")
 
         else:
             datadict = None
@@ -975,35 +2113,146 @@ def main(args):
             inputs = comm.bcast(inputs, root=0)
             datadict = comm.bcast(datadict, root=0)
 
-        dims = len(files) * nchans
-        assert len(inputs) == dims
-        count = dims // nPE
-        rem = dims % nPE
-        if myPE < rem:
-            # The first 'remainder' ranks get 'count + 1' tasks each
-            my_start = myPE * (count + 1)
-            my_end = my_start + count
+        # Blocks are handed out to the ranks as they become free
+        blocks = list(chanblocks(inputs, args.block_size))
+        if myPE == 0:
+            log.info(
+                f"There are {len(inputs)} channels to do, across {len(files)} "
+                f"files, in {len(blocks)} blocks"
+            )
 
+        nworkers = max(args.n_cores, args.n_threads)
+        if mpiSwitch and nworkers > 1:
+            log.warning("Running under MPI -- ignoring --ncores / --nthreads")
+            nworkers = 1
+        if args.fft_threads is None:
+            if mpiSwitch:
+                args.fft_threads = fft_backends.mpi_threads(comm)
+            else:
+                args.fft_threads = max(1, fft_backends.default_threads() // nworkers)
+        options = dict(
+            conv_mode=conv_mode,
+            precision=args.precision,
+            fft_backend=args.fft_backend,
+            fft_threads=args.fft_threads,
+            pad=args.pad,
+        )
+        task = functools.partial(smooth_block, datadict=datadict, **options)
+        # Start the pool before the writer thread, so no threads are forked
+        pool = None
+        processes = nworkers > 1 and args.n_cores > 1
+        if processes:
+            log.info(f"Smoothing with {nworkers} processes")
+            # Each process gets the data dict once, and each task only its
+            # (key, channels)
+            pool = multiprocessing.Pool(
+                nworkers, initializer=init_pool, initargs=(datadict,)
+            )
+            task = functools.partial(smooth_pooled, **options)
+        elif nworkers > 1:
+            log.info(f"Smoothing with {nworkers} threads")
+            pool = ThreadPool(nworkers)
+        # With processes, each reads its own blocks -- sending the planes
+        # to them would cost more than reading
+        prefetch = 0 if processes else args.prefetch
+        writer = None
+        mpi_io = args.mpi_io and mpiSwitch and args.output_format == "fits"
+        if args.mpi_io and not mpi_io:
+            log.warning("--mpi-io needs MPI and FITS output -- ignoring")
+        elif mpi_io:
+            try:
+                writer = CollectiveWriter(
+                    {key: datadict[key]["outfile"] for key in datadict},
+                    blocks,
+                    checkpoint=args.checkpoint,
+                )
+            except ValueError as err:
+                log.warning(f"{err} -- not using MPI-IO")
+        counter = None
+        if writer is None:
+            writer = CubeWriter(checkpoint=args.checkpoint)
+            # Freed below, once this rank is done, whether or not it took
+            # all of its blocks
+            counter = BlockCounter()
+            myblocks = getblocks(blocks, counter)
         else:
-            # The remaining 'size - remainder' ranks get 'count' task each
-            my_start = myPE * count + rem
-            my_end = my_start + (count - 1)
+            # Collective writes need the blocks dealt out in turn, rather
+            # than on demand
+            myblocks = iter(blocks[myPE::nPE])
+        # Taking blocks on demand is an MPI call from the reader thread
+        if (
+            prefetch
+            and mpiSwitch
+            and not isinstance(writer, CollectiveWriter)
+            and MPI.Query_thread() < MPI.THREAD_SERIALIZED
+        ):
+            log.warning("MPI was not started with thread support -- not prefetching")
+            prefetch = 0
+        reader = None
+        start = time.perf_counter()
+        busy = 0
+        nblocks = 0
+        skipped = 0
+        try:
+            if prefetch:
+                # Read ahead in one thread, smooth here, write in another
+                reader = Prefetcher(
+                    myblocks,
+                    functools.partial(read_block, datadict=datadict),
+                    depth=prefetch,
+                )
+                task = functools.partial(smooth_planes, datadict=datadict, **options)
+                todo = reader
+            else:
+                todo = myblocks
+            if pool is None:
+                results = map(task, todo)
+            else:
+                results = imap_bounded(pool, task, todo, nworkers)
+            for key, chans, newims, elapsed, nbytes in results:
+                writer.put(datadict[key]["outfile"], chans[0], newims)
+                busy += elapsed
+                nblocks += 1
+                skipped += nbytes
+        finally:
+            if reader is not None:
+                reader.close()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if counter is not None:
+                counter.free()
+            writer.close()
+        report_load(busy, start, nblocks, nworkers)
+        report_stages(
+            time.perf_counter() - start,
+            None if reader is None else (reader.busy, reader.stalled),
+            (busy, 0.0 if reader is None else reader.waited, writer.waited),
+            writer.busy,
+            nworkers,
+        )
+        if mpiSwitch:
+            skipped = comm.reduce(skipped, root=0)
         if myPE == 0:
-            log.info(f"There are {nchans} channels, across {len(files)} files")
-        log.debug(f"My start is {my_start}, my end is {my_end}")
+            log.info(
+                f"Skipped reading {(skipped*u.byte).to(u.MB)} of blanked channels"
+            )
 
-        for inp in inputs[my_start : my_end + 1]:
-            key, chan = inp
-            outfile = datadict[key]["outfile"]
-            log.debug(f"{outfile}  - channel {chan} - Started")
-            newim = worker(chan, datadict[key], conv_mode=conv_mode)
-
-            with fits.open(outfile, mode="update", memmap=True) as outfh:
-                outfh[0].data[chan, 0, :, :] = newim.astype(
-                    np.float32
-                )  # make sure data is 32-bit
-                outfh.flush()
-            log.info(f"{outfile}  - channel {chan} - Done")
+        if args.output_format == "zarr" and args.finalise:
+            # Every rank must be done writing before the stores are read.
+            # Each rank converts the outputs it initialised.
+            if mpiSwitch:
+                comm.Barrier()
+            for outfile in outfile_dict.values():
+                zarr_store.to_fits(outfile)
+
+        # With a process pool the caches live in the pool processes
+        if not processes:
+            cache_info = convolve_uv.kernel_cache_info()
+            log.info(
+                f"Kernel cache: {cache_info.hits} hits, {cache_info.misses} misses, "
+                f"{cache_info.currsize} kernels ({(cache_info.nbytes*u.byte).to(u.MB)}) cached"
+            )
 
     log.info("Done!")
 
@@ -1061,8 +2310,151 @@ def cli():
         default="robust",
         help="""Which method to use for convolution [robust].
         'robust' computes the analytic FT of the convolving Gaussian.
+        'robust_nan' is 'robust' with NaN pixels ignored (normalised convolution).
         Can also be 'scipy', 'astropy', or 'astropy_fft'.
         Note these other methods cannot cope well with small convolving beams.
+        'auto' picks the fastest valid method for each channel, using a cost
+        model calibrated at startup. The choice is logged (with -v). The other
+        methods differ from 'robust' by ~1%% of the peak, and the choice
+        depends on timings, so 'auto' can change the results from run to run.
+        """,
+    )
+
+    parser.add_argument(
+        "--precision",
+        dest="precision",
+        choices=["float64", "float32"],
+        default="float64",
+        help="""Floating point precision used for convolution [float64].
+        'float32' keeps the image, kernel and spectra in single precision.
+        Output cubes are always written as float32.
+        """,
+    )
+
+    parser.add_argument(
+        "--block_size",
+        dest="block_size",
+        type=int,
+        default=4,
+        help="""Number of channels to convolve together in one batched FFT [4].
+        Memory use scales with this.
+        """,
+    )
+
+    parser.add_argument(
+        "--prefetch",
+        dest="prefetch",
+        type=int,
+        default=2,
+        help="""Number of blocks to read ahead while smoothing [2].
+        Blocks are read in one thread, smoothed, and written in another. 0 reads
+        each block when it is smoothed. Not used with --ncores, where each
+        process reads its own blocks. Memory use scales with this.
+        """,
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        dest="checkpoint",
+        type=int,
+        default=None,
+        help="""Flush the output to disk every N channels written [None -- only at the end].
+        Channels are marked done in the journal (<outfile>.journal) at each flush.
+        """,
+    )
+
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="""Resume an interrupted run [False].
+        Outputs with a journal are not initialised again, and only the channels
+        not yet marked done are smoothed. Use --checkpoint so that progress is
+        journalled during the run.
+        """,
+    )
+
+    parser.add_argument(
+        "--mpi-io",
+        dest="mpi_io",
+        action="store_true",
+        help="""Write the output cubes with collective MPI-IO under MPI [False].
+        Blocks are dealt out to the ranks in turn rather than on demand, and each
+        round of blocks is written with one collective write per cube, which
+        MPI-IO gathers into a few large writes. Suits parallel file systems
+        (e.g. Lustre). FITS output only.
+        """,
+    )
+
+    parser.add_argument(
+        "--output-format",
+        dest="output_format",
+        choices=zarr_store.FORMATS,
+        default="fits",
+        help="""Format of the output cubes [fits].
+        'zarr' writes a Zarr store (<name>.zarr), chunked by channel, which ranks
+        fill at once with no locking. The beams are kept in its attributes.
+        Requires zarr to be installed.
+        """,
+    )
+
+    parser.add_argument(
+        "--finalise",
+        dest="finalise",
+        action="store_true",
+        help="""Convert Zarr outputs to FITS (<name>.fits) at the end [False].
+        Stores can also be converted later with racs_tools.zarr_store.
+        """,
+    )
+
+    parser.add_argument(
+        "--fft-backend",
+        dest="fft_backend",
+        choices=fft_backends.BACKENDS,
+        default="scipy",
+        help="""FFT library used by the 'robust' method [scipy].
+        'pyfftw' requires pyFFTW to be installed.
+        """,
+    )
+
+    parser.add_argument(
+        "--pad",
+        action="store_true",
+        help="""Zero pad planes to a fast FFT size in the 'robust' method [False].
+        Speeds up awkward image sizes and stops wrap-around at the edges.
+        """,
+    )
+
+    parser.add_argument(
+        "--fft-threads",
+        dest="fft_threads",
+        type=int,
+        default=None,
+        help="""Threads per FFT [CPUs available / (ncores or nthreads)].
+        Under MPI, the CPUs of each node are split between its ranks.
+        """,
+    )
+
+    group = parser.add_mutually_exclusive_group()
+
+    group.add_argument(
+        "--ncores",
+        dest="n_cores",
+        type=int,
+        default=1,
+        help="""Number of processes to smooth channel blocks with [1].
+        Ignored under MPI.
+        """,
+    )
+
+    group.add_argument(
+        "--nthreads",
+        dest="n_threads",
+        type=int,
+        default=1,
+        help="""Number of threads to smooth channel blocks with [1].
+        The FFTs release the GIL, so threads share one process and its
+        kernel cache. Ignored under MPI.
         """,
     )
 
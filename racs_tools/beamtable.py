@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+""" Array-backed beam tables for planning """
+
+import numpy as np
+from astropy import units as u
+from radio_beam import Beam, Beams
+from radio_beam.utils import BeamError
+
+BEAM_DTYPE = np.dtype([("major", "f8"), ("minor", "f8"), ("pa", "f8")])
+
+# Unit scales, as astropy applies them
+_AS2DEG = u.arcsec.to(u.deg)
+_DEG2AS = u.deg.to(u.arcsec)
+_EPS = np.finfo(np.float64).eps
+
+
+def round_up(n, decimals=0):
+    multiplier = 10 ** decimals
+    return np.ceil(n * multiplier) / multiplier
+
+
+def my_ceil(a, precision=0):
+    return np.round(a + 0.5 * 10 ** (-precision), precision)
+
+
+class BeamTable:
+    """A table of beams held in one structured array
+
+    Major and minor axes (FWHM) are kept in arcsec and position angles in
+    degrees. Every operation works on all rows at once, and follows the
+    formulae of radio_beam's Beam. Masked beams are NaN rows, which stay NaN
+    through every operation.
+
+    Args:
+        major (array_like): Major axes (arcsec)
+        minor (array_like): Minor axes (arcsec)
+        pa (array_like): Position angles (deg)
+    """
+
+    def __init__(self, major, minor, pa):
+        major, minor, pa = np.broadcast_arrays(
+            np.asarray(major, dtype=float),
+            np.asarray(minor, dtype=float),
+            np.asarray(pa, dtype=float),
+        )
+        self.data = np.empty(major.shape, dtype=BEAM_DTYPE)
+        self.data["major"] = major
+        self.data["minor"] = minor
+        self.data["pa"] = pa
+
+    @classmethod
+    def from_data(cls, data):
+        """Wrap a structured array of BEAM_DTYPE, without copying"""
+        table = cls.__new__(cls)
+        table.data = data
+        return table
+
+    @classmethod
+    def from_beams(cls, beams):
+        """Make a table from radio_beam beams
+
+        Args:
+            beams: A Beams, a Beam, or a sequence of Beam. Anything else in
+                a sequence (e.g. NaN for a blanked image) becomes a NaN row.
+
+        Returns:
+            BeamTable: The beams
+        """
+        if isinstance(beams, (Beam, Beams)):
+            return cls(
+                beams.major.to_value(u.arcsec),
+                beams.minor.to_value(u.arcsec),
+                beams.pa.to_value(u.deg),
+            )
+        rows = np.full((len(beams), 3), np.nan)
+        for row, beam in zip(rows, beams):
+            if isinstance(beam, Beam):
+                row[:] = (
+                    beam.major.to_value(u.arcsec),
+                    beam.minor.to_value(u.arcsec),
+                    beam.pa.to_value(u.deg),
+                )
+        return cls(*rows.T)
+
+    @classmethod
+    def nan(cls, shape):
+        """A table of NaN (masked) beams"""
+        return cls(np.full(shape, np.nan), np.nan, np.nan)
+
+    @classmethod
+    def stack(cls, tables, axis=0):
+        """Stack tables along a new axis, e.g. (nchans, ncubes)"""
+        return cls.from_data(np.stack([table.data for table in tables], axis=axis))
+
+    @property
+    def major(self):
+        return self.data["major"]
+
+    @property
+    def minor(self):
+        return self.data["minor"]
+
+    @property
+    def pa(self):
+        return self.data["pa"]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return self.from_data(self.data[index])
+
+    def __setitem__(self, index, value):
+        self.data[index] = value.data if isinstance(value, BeamTable) else value
+
+    def __repr__(self):
+        return f"BeamTable(shape={self.shape})"
+
+    def to_beams(self):
+        """Convert to a radio_beam Beams"""
+        return Beams(
+            major=np.ravel(self.major) * u.arcsec,
+            minor=np.ravel(self.minor) * u.arcsec,
+            pa=np.ravel(self.pa) * u.deg,
+        )
+
+    def to_beam(self):
+        """Convert a table of one beam to a radio_beam Beam"""
+        major, minor, pa = self.data.item() if self.data.ndim == 0 else self.data[0]
+        return Beam(major=major * u.arcsec, minor=minor * u.arcsec, pa=pa * u.deg)
+
+    def isnan(self):
+        """Mask of NaN (masked) beams"""
+        return np.isnan(self.major)
+
+    def iscircular(self, rtol=1e-6):
+        # Null and NaN (masked) beams are not circular
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (self.major - self.minor) / self.major <= rtol
+
+    def __eq__(self, other):
+        """Element-wise equality, to within 1e-10 deg as for Beam"""
+        atol = 1e-10 * _DEG2AS
+        equal_pa = self.iscircular() | (
+            np.abs(self.pa % 180.0 - other.pa % 180.0) < 1e-10
+        )
+        return (
+            (np.abs(self.major - other.major) < atol)
+            & (np.abs(self.minor - other.minor) < atol)
+            & equal_pa
+        )
+
+    def __ne__(self, other):
+        return ~(self == other)
+
+    def round_up(self):
+        """Round the axes up to 0.1 arcsec and the angles up to 0.01 deg"""
+        return BeamTable(
+            my_ceil(self.major, precision=1),
+            my_ceil(self.minor, precision=1),
+            round_up(self.pa, decimals=2),
+        )
+
+    @staticmethod
+    def _terms(table, scale=_AS2DEG):
+        # Terms of the beam quadratic forms. radio_beam deconvolves in
+        # degrees, but convolves in the units of the beams (arcsec here).
+        maj = table.major * scale
+        mnr = table.minor * scale
+        pa = np.deg2rad(table.pa)
+        cos, sin = np.cos(pa), np.sin(pa)
+        return (
+            (maj * cos) ** 2 + (mnr * sin) ** 2,
+            (maj * sin) ** 2 + (mnr * cos) ** 2,
+            2 * (mnr ** 2 - maj ** 2) * sin * cos,
+        )
+
+    def deconvolve(self, other, failure_returns_pointlike=False):
+        """Deconvolve the beams of other from these
+
+        Args:
+            other (BeamTable): Beams to deconvolve, broadcast against these
+            failure_returns_pointlike (bool, optional): Return a point beam
+                where deconvolution fails, rather than raise a BeamError.
+                Defaults to False.
+
+        Returns:
+            BeamTable: Deconvolved beams
+        """
+        a1, b1, g1 = self._terms(self)
+        a2, b2, g2 = self._terms(other)
+        alpha, beta, gamma = a1 - a2, b1 - b2, g1 - g2
+        s = alpha + beta
+        t = np.sqrt((alpha - beta) ** 2 + gamma ** 2)
+        failed = (
+            (alpha + _EPS < 0) | (beta + _EPS < 0) | (s < t + _EPS / 3600.0 ** 2)
+        )
+        if failed.any() and not failure_returns_pointlike:
+            raise BeamError("Beam could not be deconvolved")
+        with np.errstate(invalid="ignore"):
+            major = np.sqrt(0.5 * (s + t))
+            minor = np.sqrt(0.5 * (s - t))
+        pa = np.where(
+            np.sqrt(np.abs(gamma) + np.abs(alpha - beta)) < 1e-7 / 3600.0,
+            0.0,
+            0.5 * np.arctan2(-1.0 * gamma, alpha - beta),
+        )
+        major = np.where(failed, 0.0, major + _EPS)
+        minor = np.where(failed, 0.0, minor + _EPS)
+        pa = np.where(failed, 0.0, pa)
+        return BeamTable(major * _DEG2AS, minor * _DEG2AS, np.rad2deg(pa))
+
+    def convolve(self, other):
+        """Convolve these beams with the beams of other (broadcast)"""
+        a1, b1, g1 = self._terms(self, scale=1)
+        a2, b2, g2 = self._terms(other, scale=1)
+        alpha, beta, gamma = a1 + a2, b1 + b2, g1 + g2
+        s = alpha + beta
+        t = np.sqrt((alpha - beta) ** 2 + gamma ** 2)
+        major = np.sqrt(0.5 * (s + t))
+        minor = np.sqrt(0.5 * (s - t))
+        pa = np.where(
+            np.isclose(np.sqrt(np.abs(gamma) + np.abs(alpha - beta)), 1e-7),
+            0.0,
+            0.5 * np.arctan2(-1.0 * gamma, alpha - beta),
+        )
+        return BeamTable(major, minor, np.rad2deg(pa))
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+""" Common beam solver for large sets of beams """
+
+import numpy as np
+from radio_beam.commonbeam import common_2beams
+from radio_beam.utils import BeamError
+from scipy.spatial import ConvexHull
+from racs_tools.beamtable import BeamTable
+import logging as log
+
+
+def covariance(beams):
+    """Covariance (Sxx, Sxy, Syy) of each beam, in arcsec^2 (up to a constant)"""
+    pa = np.deg2rad(beams.pa)
+    cos, sin = np.cos(pa), np.sin(pa)
+    maj2, min2 = beams.major ** 2, beams.minor ** 2
+    return (
+        maj2 * cos ** 2 + min2 * sin ** 2,
+        (maj2 - min2) * sin * cos,
+        maj2 * sin ** 2 + min2 * cos ** 2,
+    )
+
+
+def from_covariance(sxx, sxy, syy):
+    """The beam with covariance (Sxx, Sxy, Syy)"""
+    evals, evecs = np.linalg.eigh(np.array([[sxx, sxy], [sxy, syy]]))
+    # Angle of the major axis, folded into (-90, 90]
+    pa = np.rad2deg(np.arctan2(evecs[1, 1], evecs[0, 1]))
+    pa = (pa + 90) % 180 - 90
+    if pa == -90:
+        pa = 90.0
+    return BeamTable(np.sqrt(evals[1]), np.sqrt(evals[0]), pa)
+
+
+def prune(beams, nangles=180, slack=1e-3, chunk=4096):
+    """Find the beams that can constrain the common beam
+
+    A beam only constrains the common beam if it reaches out as far as any
+    other beam in some direction -- i.e. it is on the 'hull' of the beams.
+    Beams inside the hull are dominated and can be dropped. Directions are
+    sampled, so `slack` keeps the beams that come close.
+
+    Args:
+        beams (BeamTable): Unique beams
+        nangles (int, optional): Directions sampled over 180 deg.
+        slack (float, optional): Fractional margin on the squared extent.
+        chunk (int, optional): Beams per array operation.
+
+    Returns:
+        ndarray: Mask of beams to keep
+    """
+    theta = np.linspace(0, np.pi, nangles, endpoint=False)
+    cos, sin = np.cos(theta), np.sin(theta)
+    sxx, sxy, syy = covariance(beams)
+
+    def extent(sl):
+        # Squared extent of the beams (rows) in each direction (columns)
+        return (
+            sxx[sl, None] * cos ** 2
+            + 2 * sxy[sl, None] * sin * cos
+            + syy[sl, None] * sin ** 2
+        )
+
+    chunks = [slice(i, i + chunk) for i in range(0, len(beams), chunk)]
+    hull = np.max([extent(sl).max(axis=0) for sl in chunks], axis=0)
+    return np.concatenate(
+        [(extent(sl) >= (1 - slack) * hull).any(axis=1) for sl in chunks]
+    )
+
+
+def hull_beams(beams):
+    """Reduce a set of beams to the unique beams on its hull
+
+    These are the only beams that can constrain the common beam, so the
+    common beam of the result is that of the whole set. As a beam dropped
+    from part of a set is dropped from the whole, sets can be reduced
+    piecewise and the results merged (with merge_hulls) in any order, e.g.
+    in a tree over ranks, to the same result as reducing the whole set.
+
+    Args:
+        beams (BeamTable): Beams. NaN (masked) beams are ignored.
+
+    Returns:
+        BeamTable: Unique beams on the hull (1D, sorted)
+    """
+    data = np.ravel(beams.data)
+    unique = BeamTable.from_data(np.unique(data[~np.isnan(data["major"])]))
+    if len(unique) == 0:
+        return unique
+    return unique[prune(unique)]
+
+
+def merge_hulls(hull1, hull2):
+    """Merge two sets reduced by hull_beams"""
+    return hull_beams(BeamTable.from_data(np.concatenate([hull1.data, hull2.data])))
+
+
+def edges(beams, nsamps, epsilon):
+    """Points on the edges of the beams, grown by 1 + epsilon
+
+    Only half of each edge is needed, as the common beam is centred.
+
+    Returns:
+        ndarray: Points (len(beams), nsamps // 2, 2)
+    """
+    phi = np.linspace(0, np.pi, max(nsamps // 2, 2), endpoint=False)
+    pa = np.deg2rad(beams.pa)[:, None]
+    x = (beams.major * (1 + epsilon))[:, None] * np.cos(phi)
+    y = (beams.minor * (1 + epsilon))[:, None] * np.sin(phi)
+    return np.stack(
+        [x * np.cos(pa) - y * np.sin(pa), x * np.sin(pa) + y * np.cos(pa)], axis=-1
+    )
+
+
+def khachiyan(pts, weights, tolerance, maxiter=100000):
+    """Khachiyan's algorithm for the minimum volume centred ellipse
+
+    With Wolfe-Atwood 'away' steps (Todd & Yildirim 2007), which let the
+    weights of points that turn out to be inside the ellipse drop again, so
+    a start from a nearby solution is cheap. Iterations stop once every
+    point is within the ellipse grown by sqrt(1 + tolerance), so the ellipse
+    grown by 1 + tolerance (as radio_beam does) holds every point.
+
+    Args:
+        pts (ndarray): Points (N, 2)
+        weights (ndarray): Starting weights (N,), summing to 1
+        tolerance (float): Fractional growth of the ellipse to hold all points
+        maxiter (int, optional): Most iterations
+
+    Returns:
+        tuple: (covariance (Sxx, Sxy, Syy) of the ellipse, final weights,
+            number of iterations)
+    """
+    d = 2.0
+    u = weights.copy()
+    xx, xy, yy = pts[:, 0] ** 2, pts[:, 0] * pts[:, 1], pts[:, 1] ** 2
+    for i in range(maxiter):
+        a, b, c = u @ xx, u @ xy, u @ yy
+        # x^T Q^-1 x for every point, with Q = sum(u x x^T)
+        m = (c * xx - 2 * b * xy + a * yy) / (a * c - b * b)
+        j = np.argmax(m)
+        if m[j] <= d * (1 + tolerance):
+            break
+        # Take weight from the point deepest inside, if that gains more
+        k = np.argmin(np.where(u > 0, m, np.inf))
+        if m[j] - d >= d - m[k]:
+            step = (m[j] - d) / (d * (m[j] - 1))
+        else:
+            j = k
+            drop = -u[k] / (1 - u[k])
+            step = max((m[k] - d) / (d * (m[k] - 1)), drop) if m[k] > 1 else drop
+        u = (1 - step) * u
+        u[j] = max(u[j] + step, 0.0)
+    else:
+        raise BeamError(
+            "Reached maximum iterations without converging. Try increasing"
+            " the tolerance."
+        )
+    return (d * a, d * b, d * c), u, i
+
+
+def contains(common, beams):
+    """Mask of the beams that common can be deconvolved from"""
+    deconv = common.deconvolve(beams, failure_returns_pointlike=True)
+    return (deconv.major > 0) | (common == beams)
+
+
+class CommonBeamSolver:
+    """Finds the smallest beam that a set of beams can all be convolved to
+
+    Identical beams are merged and beams dominated by others are dropped
+    first, as only the beams on the hull constrain the common beam. The
+    minimum enclosing ellipse of the edges of the rest is found with
+    Khachiyan's algorithm, as in radio_beam.
+
+    If the result cannot be deconvolved from every beam, the tolerance is
+    tightened (up to `refine` times, by 10 each), carrying on from the
+    current solution rather than starting again. Beams dropped in error are
+    added back and, as a last resort, epsilon is increased as in radio_beam.
+
+    The weights of the solution are kept, by beam (row of the table) and
+    edge point, to start the next solve from. Successive channels of a set
+    of cubes are usually constrained by the same few beams, so a solve
+    warm-started from the adjacent channel takes a few iterations.
+
+    Args:
+        tolerance (float, optional): Khachiyan tolerance. Defaults to 1e-4.
+        nsamps (int, optional): Edge points per beam. Defaults to 200.
+        epsilon (float, optional): Growth of the beams. Defaults to 5e-4.
+        max_epsilon (float, optional): Largest epsilon. Defaults to 1e-3.
+        max_iter (int, optional): Steps to increase epsilon. Defaults to 10.
+        refine (int, optional): Times to tighten the tolerance. Defaults to 2.
+    """
+
+    def __init__(
+        self,
+        tolerance=1e-4,
+        nsamps=200,
+        epsilon=5e-4,
+        max_epsilon=1e-3,
+        max_iter=10,
+        refine=2,
+    ):
+        self.tolerance = tolerance
+        self.nsamps = nsamps
+        self.epsilon = epsilon
+        self.max_epsilon = max_epsilon
+        self.max_iter = max_iter
+        self.refine = refine
+        # {row: weights of its edge points} of the last solution
+        self.support = {}
+        self.iterations = 0
+
+    def _weights(self, rows, nphi, pts, onhull):
+        """Starting weights of the edge points (on the hull) of the beams in rows"""
+        weights = np.array(
+            [self.support.get(row, np.zeros(nphi)) for row in rows]
+        ).ravel()[onhull]
+        uniform = np.full(len(weights), 1 / len(weights))
+        if weights.sum() == 0:
+            return uniform
+        weights /= weights.sum()
+        # The ellipse of the weights must not be degenerate
+        q = (pts * weights[:, None]).T @ pts
+        if np.linalg.det(q) <= 1e-6 * np.trace(q) ** 2:
+            weights = 0.5 * (weights + uniform)
+        return weights
+
+    def solve(self, beams, warm=True):
+        """Find the common beam
+
+        Args:
+            beams (BeamTable): Beams (1D). NaN (masked) beams are ignored.
+            warm (bool, optional): Start from the last solution.
+                Defaults to True.
+
+        Returns:
+            BeamTable: The common beam (one beam)
+
+        Raises:
+            BeamError: If no common beam could be found
+        """
+        if not warm:
+            self.support = {}
+        good = np.flatnonzero(~beams.isnan())
+        if len(good) == 0:
+            raise BeamError("No beams to find a common beam for")
+        # Rows of the first of each set of identical beams
+        data, first = np.unique(beams.data[good], return_index=True)
+        unique = BeamTable.from_data(data)
+        rows = good[first]
+        keep = prune(unique)
+        log.debug(
+            f"Common beam of {len(good)} beams: {len(unique)} unique,"
+            f" {keep.sum()} on the hull"
+        )
+
+        if keep.sum() == 1:
+            common = unique[keep][0]
+            if contains(common, unique).all():
+                return common
+        elif keep.sum() == 2:
+            # The exact solution for two beams
+            try:
+                common = BeamTable.from_beams(common_2beams(unique[keep].to_beams()))
+                if contains(common, unique).all():
+                    return common
+            except (ValueError, BeamError):
+                pass
+
+        step = 1
+        tol = self.tolerance
+        epsilon = self.epsilon
+        while True:
+            pts = edges(unique[keep], self.nsamps, epsilon)
+            nbeams, nphi = pts.shape[:2]
+            pts = pts.reshape(-1, 2)
+            # Only points on the (symmetric) convex hull can touch the ellipse
+            both = np.concatenate([pts, -pts])
+            onhull = np.unique(ConvexHull(both).vertices % len(pts))
+            weights = self._weights(rows[keep], nphi, pts[onhull], onhull)
+            cov, weights, niter = khachiyan(pts[onhull], weights, tol)
+            self.iterations += niter
+            support = np.zeros(len(pts))
+            support[onhull] = weights
+            self.support = dict(zip(rows[keep], support.reshape(nbeams, nphi)))
+            common = from_covariance(*cov)
+            # Grow as radio_beam does, by the tolerance
+            common = BeamTable(
+                common.major * (1 + self.tolerance),
+                common.minor * (1 + self.tolerance),
+                common.pa,
+            )
+            ok = contains(common, unique)
+            log.debug(f"Khachiyan: {niter} iterations at tolerance {tol:g}")
+            if ok.all():
+                return common
+            missed = ~ok & ~keep
+            if missed.any():
+                # Dropped in error -- put them back
+                keep |= missed
+            elif tol > self.tolerance * 0.1 ** self.refine:
+                tol *= 0.1
+                log.warning(
+                    f"Common beam does not fit all beams -- refining with"
+                    f" tolerance {tol:g}"
+                )
+            else:
+                epsilon += (step + 1) * (self.max_epsilon - epsilon) / self.max_iter
+                step += 1
+                if step == self.max_iter + 1:
+                    raise BeamError(
+                        "Could not find common beam to deconvolve all beams."
+                    )
+
+
+def common_beam(beams, **kwargs):
+    """Find the common beam of a set of beams -- see CommonBeamSolver
+
+    Args:
+        beams (BeamTable): Beams. NaN (masked) beams are ignored.
+        **kwargs: Passed to CommonBeamSolver
+
+    Returns:
+        BeamTable: The common beam (one beam)
+    """
+    return CommonBeamSolver(**kwargs).solve(BeamTable.from_data(np.ravel(beams.data)))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+""" Cost model for choosing a convolution method """
+
+import time
+import functools
+from collections import namedtuple
+import numpy as np
+import scipy.fft
+import scipy.signal
+from astropy import units as u
+from astropy.convolution import convolve, convolve_fft
+from radio_beam import Beam
+from racs_tools import convolve_uv
+import logging as log
+
+Choice = namedtuple("Choice", ["method", "predicted", "term"])
+
+
+def _best_time(func, repeat=3):
+    """Shortest wall time of func() over repeat calls"""
+    best = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def _nlogn(shape):
+    n = float(np.prod(shape))
+    return n * np.log2(n)
+
+
+class CostModel:
+    """Predicts the run time of each convolution method for a plane.
+
+    Every method is reduced to a single cost term -- N log N for the FFT
+    methods and image size x kernel size for direct convolution -- times a
+    coefficient in seconds. The coefficients come from a short benchmark
+    on a small image, and are refined from the measured time of each plane
+    as it is done.
+
+    Args:
+        backend (optional): FFT backend for the 'robust' methods.
+        pad (bool, optional): Whether the 'robust' methods pad the image.
+            Defaults to False.
+    """
+
+    def __init__(self, backend=None, pad=False):
+        self.backend = backend
+        self.pad = pad
+        self.coefs = {}
+
+    def calibrate(self, size=256):
+        """Time each method on a size x size image and a 4 pixel beam"""
+        rng = np.random.default_rng(0)
+        image = rng.standard_normal((size, size))
+        dx = 1 * u.arcsec
+        oldbeam = Beam(2 * u.arcsec)
+        conbeam = Beam(4 * u.arcsec)
+        newbeam = oldbeam.convolve(conbeam)
+        kernel = conbeam.as_kernel(dx).array
+        shape, kshape = image.shape, kernel.shape
+
+        # Warm up the kernel cache and FFT plans first
+        convolve_uv.convolve(
+            image, oldbeam, newbeam, -dx, dx, backend=self.backend, pad=self.pad
+        )
+        fshape = self._fshape(shape, newbeam, -dx, dx)
+        self.coefs["robust"] = _best_time(
+            lambda: convolve_uv.convolve(
+                image, oldbeam, newbeam, -dx, dx, backend=self.backend, pad=self.pad
+            )
+        ) / _nlogn(fshape)
+        self.coefs["scipy_fft"] = _best_time(
+            lambda: scipy.signal.convolve(image, kernel, mode="same", method="fft")
+        ) / _nlogn(np.add(shape, kshape) - 1)
+        self.coefs["scipy_direct"] = _best_time(
+            lambda: scipy.signal.convolve(image, kernel, mode="same", method="direct"),
+            repeat=1,
+        ) / (np.prod(shape) * np.prod(kshape))
+        self.coefs["astropy"] = _best_time(
+            lambda: convolve(image, kernel, normalize_kernel=False), repeat=1
+        ) / (np.prod(shape) * np.prod(kshape))
+        self.coefs["astropy_fft"] = _best_time(
+            lambda: convolve_fft(image, kernel, normalize_kernel=False)
+        ) / _nlogn(self._astropy_fft_shape(shape, kshape))
+        log.info(
+            "Calibrated convolution cost model: "
+            + ", ".join(f"{k}={v:.3g}" for k, v in self.coefs.items())
+        )
+        return self
+
+    def _fshape(self, shape, newbeam, dx, dy):
+        if self.pad:
+            return convolve_uv.padded_shape(shape, newbeam, dx, dy)
+        return shape
+
+    @staticmethod
+    def _astropy_fft_shape(shape, kshape):
+        # convolve_fft pads by the kernel, then to a fast length
+        return [scipy.fft.next_fast_len(int(n)) for n in np.add(shape, kshape)]
+
+    def predict(self, method, shape, kshape, fshape, has_nans=False):
+        """Predicted run time of a method
+
+        Args:
+            method (str): Convolution method.
+            shape (tuple): Shape of the image.
+            kshape (tuple): Shape of the convolving kernel image.
+            fshape (tuple): FFT shape of the 'robust' methods.
+            has_nans (bool, optional): Whether the image has NaNs.
+
+        Returns:
+            tuple: (seconds, name of the cost term used)
+        """
+        if method in ("robust", "robust_nan"):
+            # NaNs add a plane of weights to the transform
+            nplanes = 2 if method == "robust_nan" and has_nans else 1
+            return nplanes * self.coefs["robust"] * _nlogn(fshape), "robust"
+        elif method == "scipy":
+            term = "scipy_" + scipy.signal.choose_conv_method(
+                np.broadcast_to(0.0, shape), np.broadcast_to(0.0, kshape), mode="same"
+            )
+        else:
+            term = method
+        if term in ("scipy_direct", "astropy"):
+            work = np.prod(shape) * np.prod(kshape)
+        elif term == "scipy_fft":
+            work = _nlogn(np.add(shape, kshape) - 1)
+        else:
+            work = _nlogn(self._astropy_fft_shape(shape, kshape))
+        return self.coefs[term] * work, term
+
+    def choose(self, shape, conbeam, newbeam, dx, dy, has_nans=False, name=None):
+        """Choose the fastest valid method for a plane
+
+        With NaNs, 'robust' is replaced by 'robust_nan' and 'scipy', which
+        spreads them, is left out. The kernel-image methods are only valid
+        when the convolving beam is Nyquist sampled. Their results differ
+        from 'robust' (by ~1% of the peak), so the choice is logged at INFO.
+
+        Args:
+            shape (tuple): Shape of the image.
+            conbeam (Beam): Convolving beam.
+            newbeam (Beam): Target beam.
+            dx (Quantity): Grid size in x (e.g. CDELT1)
+            dy (Quantity): Grid size in y (e.g. CDELT2)
+            has_nans (bool, optional): Whether the image has NaNs.
+            name (str, optional): The plane, for the log (e.g. its file).
+
+        Returns:
+            Choice: (method, predicted seconds, cost term)
+        """
+        methods = ["robust_nan" if has_nans else "robust"]
+        kshape = (0, 0)
+        if (conbeam.minor / abs(dy)).decompose().value >= 2:
+            kshape = conbeam.as_kernel(abs(dy)).array.shape
+            methods += ["astropy", "astropy_fft"]
+            if not has_nans:
+                methods.append("scipy")
+        fshape = self._fshape(shape, newbeam, dx, dy)
+        choices = [
+            Choice(method, *self.predict(method, shape, kshape, fshape, has_nans))
+            for method in methods
+        ]
+        choice = min(choices, key=lambda c: c.predicted)
+        log.info(
+            f"Auto-selected {choice.method} for {name or 'plane'} {shape} "
+            f"(predicted {choice.predicted:.3g} s)"
+        )
+        return choice
+
+    def update(self, choice, actual):
+        """Log the predicted and actual time, and refine the coefficient"""
+        log.info(
+            f"{choice.method}: predicted {choice.predicted:.3g} s, "
+            f"took {actual:.3g} s"
+        )
+        if choice.predicted > 0 and actual > 0:
+            # Damped, so that one noisy timing can't flip later choices
+            self.coefs[choice.term] *= np.sqrt(actual / choice.predicted)
+
+
+@functools.lru_cache(maxsize=None)
+def get_model(backend=None, pad=False):
+    """Get a calibrated cost model. Models are cached per process.
+
+    Args:
+        backend (optional): FFT backend for the 'robust' methods.
+        pad (bool, optional): Whether the 'robust' methods pad the image.
+
+    Returns:
+        CostModel: Calibrated model
+    """
+    return CostModel(backend=backend, pad=pad).calibrate()
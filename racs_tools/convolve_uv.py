@@ -2,16 +2,288 @@
 """ Fast convolution in the UV domain """
 __author__ = "Wasim Raja"
 
+import threading
+from collections import OrderedDict, namedtuple
 import numpy as np
+import scipy.fft
+import logging as log
 import astropy.units as units
 import racs_tools.gaussft as gaussft
+from racs_tools import fft_backends
 
-def convolve(image, old_beam, new_beam, dx, dy):
+KernelCacheInfo = namedtuple(
+    "KernelCacheInfo", ["hits", "misses", "currsize", "nbytes", "maxbytes"]
+)
+
+
+class KernelCache:
+    """Bounded LRU cache of Fourier-domain Gaussian kernels.
+
+    The cache is limited by the total size of the stored arrays rather than
+    by the number of entries. Kernels larger than the limit are never stored.
+    Cached arrays are read-only.
+
+    Args:
+        maxbytes (int, optional): Memory limit in bytes. Defaults to 1 GiB.
+    """
+
+    def __init__(self, maxbytes=2 ** 30):
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._kernels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a kernel, or None if it is not cached"""
+        with self._lock:
+            try:
+                value = self._kernels[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._kernels.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, g_final, g_ratio):
+        """Store a kernel, evicting the least recently used ones to make room"""
+        if g_final.nbytes > self.maxbytes:
+            return
+        g_final.flags.writeable = False
+        with self._lock:
+            if key in self._kernels:
+                return
+            while self._kernels and self.nbytes + g_final.nbytes > self.maxbytes:
+                _, (old, _) = self._kernels.popitem(last=False)
+                self.nbytes -= old.nbytes
+            self._kernels[key] = (g_final, g_ratio)
+            self.nbytes += g_final.nbytes
+
+    def resize(self, maxbytes):
+        """Change the memory limit, evicting kernels if needed"""
+        with self._lock:
+            self.maxbytes = maxbytes
+            while self._kernels and self.nbytes > self.maxbytes:
+                _, (old, _) = self._kernels.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def clear(self):
+        """Empty the cache and reset the counters"""
+        with self._lock:
+            self._kernels.clear()
+            self.hits = self.misses = self.nbytes = 0
+
+    def info(self):
+        """Get the cache statistics
+
+        Returns:
+            KernelCacheInfo: hits, misses, currsize, nbytes, maxbytes
+        """
+        with self._lock:
+            return KernelCacheInfo(
+                self.hits, self.misses, len(self._kernels), self.nbytes, self.maxbytes
+            )
+
+
+_kernel_cache = KernelCache()
+
+
+def kernel_cache_info():
+    """Get the statistics of the kernel cache of this process
+
+    Returns:
+        KernelCacheInfo: hits, misses, currsize, nbytes, maxbytes
+    """
+    return _kernel_cache.info()
+
+
+def set_kernel_cache_size(maxbytes):
+    """Set the memory limit (bytes) of the kernel cache. 0 disables it."""
+    _kernel_cache.resize(maxbytes)
+
+
+def clear_kernel_cache():
+    """Empty the kernel cache and reset its counters"""
+    _kernel_cache.clear()
+
+
+_work_buffers = threading.local()
+
+
+def work_buffer(name, shape, dtype=np.float64):
+    """Get a reusable scratch array.
+
+    Each thread keeps one buffer per name, which grows as needed but is
+    never freed. Every call with the same name hands out the same memory,
+    so the contents only live until the next call.
+
+    Args:
+        name (str): Name of the buffer.
+        shape (tuple): Shape of the array.
+        dtype (dtype, optional): Data type. Defaults to float64.
+
+    Returns:
+        ndarray: Uninitialised array
+    """
+    buffers = getattr(_work_buffers, "buffers", None)
+    if buffers is None:
+        buffers = _work_buffers.buffers = {}
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buf = buffers.get(name)
+    if buf is None or buf.nbytes < nbytes:
+        buf = buffers[name] = np.empty(nbytes, dtype=np.uint8)
+    return buf[:nbytes].view(dtype).reshape(shape)
+
+
+def clear_work_buffers():
+    """Free the scratch arrays of the calling thread"""
+    _work_buffers.buffers = {}
+
+
+def _quantise(beam, decimals=9):
+    """Beam parameters rounded to nano-arcsec / nano-deg"""
+    return (
+        round(beam.major.to(units.arcsec).value, decimals),
+        round(beam.minor.to(units.arcsec).value, decimals),
+        round(beam.pa.to(units.deg).value, decimals),
+    )
+
+
+def _gaussft_half(old, new, nx, ny, dx, dy):
+    """Evaluate gaussft on the rfft half-plane
+
+    Args:
+        old (tuple): Current PSF (major, minor, pa) in (arcsec, arcsec, deg)
+        new (tuple): Target PSF (major, minor, pa) in (arcsec, arcsec, deg)
+        nx (int): Length of the first image axis
+        ny (int): Length of the last image axis
+        dx (float): Grid size along the first axis in radians
+        dy (float): Grid size along the last axis in radians
+
+    Returns:
+        tuple: (kernel of shape (nx, ny // 2 + 1), scaling factor)
+    """
+    # The coordinates in FT domain. The image is real, so its FT is
+    # Hermitian and only the non-negative frequencies of the last axis
+    # are needed. The Gaussian kernel is symmetric under (u, v) -> (-u, -v),
+    # so evaluating it on the same half-plane is sufficient.
+    u = np.fft.fftfreq(nx, d=dx)
+    v = np.fft.rfftfreq(ny, d=dy)
+    ny_half = v.shape[0]
+    # Nyquist frequencies are their own negative on the grid, so the kernel
+    # is not symmetric there. Taking the real part of a full complex
+    # transform averages the two. Evaluate the mirrored Nyquist row and
+    # column as well so the same average can be formed below.
+    if nx % 2 == 0:
+        u = np.append(u, -u[nx // 2])
+    if ny % 2 == 0:
+        v = np.append(v, -v[-1])
+
+    [g_final, g_ratio] = gaussft.gaussft(bmin_in=old[1] / 3600,
+                                         bmaj_in=old[0] / 3600,
+                                         bpa_in=old[2],
+                                         bmin=new[1] / 3600,
+                                         bmaj=new[0] / 3600,
+                                         bpa=new[2],
+                                         u=u, v=v,
+                                         nx=u.shape[0], ny=v.shape[0])
+    if ny % 2 == 0:
+        rows = np.arange(nx)
+        if nx % 2 == 0:
+            rows[nx // 2] = nx
+        g_final[:nx, ny_half - 1] = 0.5 * (
+            g_final[:nx, ny_half] + g_final[rows, ny_half - 1]
+        )
+    if nx % 2 == 0:
+        # The Nyquist corner, if any, was averaged with the column above
+        cols = ny_half - 1 if ny % 2 == 0 else ny_half
+        g_final[nx // 2, :cols] = 0.5 * (g_final[nx // 2, :cols] + g_final[nx, :cols])
+    return g_final[:nx, :ny_half], g_ratio
+
+
+def get_kernel(old_beam, new_beam, shape, dx, dy, dtype=np.float64):
+    """Get the FT of the convolving Gaussian on the rfft half-plane.
+
+    Kernels are cached, keyed on the beams (quantised to nano-arcsec and
+    nano-degree), the image shape, the grid and the precision.
+
+    Args:
+        old_beam (radio_beam.Beam): Current image PSF.
+        new_beam (radio_beam.Beam): Target image PSF.
+        shape (tuple): Shape of the 2D image.
+        dx (Quantity): Grid size in x (e.g. CDELT1)
+        dy (Quantity): Grid size in y (e.g. CDELT2)
+        dtype (dtype, optional): Precision of the kernel. Defaults to float64.
+
+    Returns:
+        tuple: (read-only kernel array, scaling factor)
+    """
+    nx, ny = shape
+    old = _quantise(old_beam)
+    new = _quantise(new_beam)
+    dx = dx.to(units.rad).value
+    dy = dy.to(units.rad).value
+    dtype = np.dtype(dtype)
+    key = (old, new, nx, ny, dx, dy, dtype.str)
+    cached = _kernel_cache.get(key)
+    if cached is not None:
+        return cached
+    g_final, g_ratio = _gaussft_half(old, new, nx, ny, dx, dy)
+    g_final = g_final.astype(dtype)
+    _kernel_cache.put(key, g_final, g_ratio)
+    return g_final, g_ratio
+
+
+def padded_shape(shape, new_beam, dx, dy, nsigma=5):
+    """Get an FFT-friendly shape with room for the kernel support
+
+    Each axis is extended by at least the full width (+/- nsigma) of the
+    target beam, which bounds the convolving beam, and then rounded up to
+    the next length that the FFT handles quickly.
+
+    Args:
+        shape (tuple): Shape of the 2D image.
+        new_beam (radio_beam.Beam): Target image PSF.
+        dx (Quantity): Grid size in x (e.g. CDELT1)
+        dy (Quantity): Grid size in y (e.g. CDELT2)
+        nsigma (float, optional): Kernel half-width in sigma. Defaults to 5.
+
+    Returns:
+        tuple: Padded shape
+    """
+    return tuple(
+        scipy.fft.next_fast_len(n + 2 * _halfwidth(new_beam, d, nsigma), real=True)
+        for n, d in zip(shape, (dx, dy))
+    )
+
+
+def _halfwidth(beam, d, nsigma=5):
+    """Half-width of the beam's major axis (+/- nsigma) in pixels of size d"""
+    sigma = beam.major / (2 * np.sqrt(2 * np.log(2)))
+    return int(np.ceil(nsigma * (sigma / abs(d)).decompose().value))
+
+
+def convolve(
+    image, old_beam, new_beam, dx, dy, backend=None, pad=False, nan_aware=False
+):
     """Convolve by X-ing in the Fourier domain.
         - convolution with Gaussian kernels only 
         - no need for generation of a kernel image
         - direct computation of the FT of the kernel
         - dimension of FT = dimension of image
+        - real-to-complex FFT, so the kernel is only evaluated on
+          the non-negative half-plane of the last axis
+        - single precision (float32) images stay in single precision,
+          including the kernel and the complex64 spectrum
+        - kernels are cached (see get_kernel)
+        - optionally, the image is zero padded to a fast FFT length with room
+          for the kernel (see padded_shape), and cropped back afterwards.
+          This also stops emission wrapping around the edges.
+        - optionally, NaNs are handled by normalised convolution
+          (see convolve_stack)
 
     Args:
         image (2D array): The image to be convolved.
@@ -19,33 +291,41 @@ def convolve(image, old_beam, new_beam, dx, dy):
         new_beam (radio_beam.Beam): Target image PSF.
         dx (float): Grid size in x in degrees (e.g. CDELT1)
         dy (float): Grid size in y in degrees (e.g. CDELT2)
+        backend (optional): FFT backend from fft_backends.get_backend.
+            Defaults to scipy.fft on all available CPUs.
+        pad (bool, optional): Pad to a fast FFT size. Defaults to False.
+        nan_aware (bool, optional): Use normalised convolution to ignore NaNs.
+            Defaults to False.
 
     Returns:
         tuple: (convolved image, scaling factor)
     """
-    nx = image.shape[0]
-    ny = image.shape[1]
-
-    # The coordinates in FT domain:
-    u = np.fft.fftfreq(nx, d=dx.to(units.rad).value)
-    v = np.fft.fftfreq(ny, d=dy.to(units.rad).value)
-
-    g_final = np.zeros((nx, ny), dtype=float)
-    [g_final, g_ratio] = gaussft.gaussft(bmin_in=old_beam.minor.to(units.deg).value,
-                                         bmaj_in=old_beam.major.to(units.deg).value,
-                                         bpa_in=old_beam.pa.to(units.deg).value,
-                                         bmin=new_beam.minor.to(units.deg).value,
-                                         bmaj=new_beam.major.to(units.deg).value,
-                                         bpa=new_beam.pa.to(units.deg).value,
-                                         u=u, v=v,
-                                         nx=nx, ny=ny)
+    if nan_aware:
+        im_conv, g_ratios = convolve_stack(
+            image[np.newaxis],
+            [old_beam],
+            [new_beam],
+            dx,
+            dy,
+            backend=backend,
+            pad=pad,
+            nan_aware=True,
+        )
+        return im_conv[0], g_ratios[0]
+    if backend is None:
+        backend = fft_backends.get_backend()
+    nx, ny = image.shape
+    fshape = padded_shape(image.shape, new_beam, dx, dy) if pad else image.shape
     # Perform the x-ing in the FT domain
-    im_f = np.fft.fft2(image)
+    im_f = backend.rfftn(image, axes=(0, 1), s=fshape)
+    # gaussft is real*8 -- match the working precision of the spectrum
+    g_final, g_ratio = get_kernel(
+        old_beam, new_beam, fshape, dx, dy, dtype=im_f.real.dtype
+    )
 
     # Now convolve with the desired Gaussian:
-    M = np.multiply(im_f, g_final)
-    im_conv = np.fft.ifft2(M)
-    im_conv = np.real(im_conv)
+    im_f *= g_final
+    im_conv = backend.irfftn(im_f, s=fshape, axes=(0, 1))[:nx, :ny]
 
     # print("factor: %f" % g_ratio)
     # print("dx: %s" % dx)
@@ -63,3 +343,263 @@ def convolve(image, old_beam, new_beam, dx, dy):
     # tmp = bpa
     # print("bPA desired: %f " % tmp)
     return im_conv, g_ratio
+
+
+def convolve_stack(
+    cube_block,
+    old_beams,
+    new_beams,
+    dx,
+    dy,
+    backend=None,
+    pad=False,
+    nan_aware=False,
+    out=None,
+):
+    """Convolve a stack of planes by X-ing in the Fourier domain.
+
+    As for convolve, but all planes are transformed in one batched,
+    multi-threaded FFT over the last two axes. Each plane gets its own
+    kernel.
+
+    With nan_aware, each plane containing NaNs is convolved with NaNs set to
+    zero, alongside a plane marking the NaNs (1 where NaN, 0 elsewhere) in
+    the same batch. Dividing by one minus the smoothed mask renormalises the
+    result by the fraction of the kernel that fell on valid pixels. Padding
+    is not masked, so it counts as zeros, as for planes without NaNs, and
+    every plane gets the same edges. Pixels that were NaN stay NaN.
+
+    Args:
+        cube_block (3D array): Planes to be convolved, shape (nchan, ny, nx).
+        old_beams (radio_beam.Beams): Current PSF of each plane.
+        new_beams (radio_beam.Beams): Target PSF of each plane.
+        dx (Quantity): Grid size in x (e.g. CDELT1)
+        dy (Quantity): Grid size in y (e.g. CDELT2)
+        backend (optional): FFT backend from fft_backends.get_backend.
+            Defaults to scipy.fft on all available CPUs.
+        pad (bool, optional): Pad to a fast FFT size large enough for the
+            biggest target beam. Defaults to False.
+        nan_aware (bool, optional): Use normalised convolution to ignore NaNs.
+            Defaults to False.
+        out (ndarray, optional): Array (nchan, ny, nx) for the convolved
+            planes, already multiplied by their scaling factors. The planes
+            are transformed back and written one at a time, so no stack of
+            them is made at the working precision. May be cube_block.
+            Defaults to None (a new array, not scaled).
+
+    Returns:
+        tuple: (convolved planes, array of scaling factors)
+    """
+    shape = cube_block.shape[1:]
+    if pad:
+        fshape = padded_shape(shape, max(new_beams, key=lambda b: b.major), dx, dy)
+    else:
+        fshape = shape
+    return _convolve_stack(
+        cube_block, old_beams, new_beams, dx, dy, fshape, backend, nan_aware, out
+    )
+
+
+def _convolve_stack(
+    cube_block,
+    old_beams,
+    new_beams,
+    dx,
+    dy,
+    fshape,
+    backend=None,
+    nan_aware=False,
+    out=None,
+):
+    """convolve_stack on an FFT grid of shape fshape (>= the plane shape)"""
+    if backend is None:
+        backend = fft_backends.get_backend()
+    nchan = len(cube_block)
+    nx, ny = shape = cube_block.shape[1:]
+    has_nans = []
+    blanks = None
+    if nan_aware:
+        has_nans = [i for i, plane in enumerate(cube_block) if np.isnan(plane).any()]
+    if has_nans:
+        # The planes with NaNs zeroed, followed by a mask of the NaNs for each
+        stack = work_buffer(
+            "nan_stack", (nchan + len(has_nans),) + shape, cube_block.dtype
+        )
+        stack[:nchan] = cube_block
+        blanks = np.empty((len(has_nans),) + shape, dtype=bool)
+        for j, i in enumerate(has_nans):
+            np.isnan(cube_block[i], out=blanks[j])
+            stack[i][blanks[j]] = 0
+            stack[nchan + j] = blanks[j]
+        cube_block = stack
+        old_beams = list(old_beams) + [old_beams[i] for i in has_nans]
+        new_beams = list(new_beams) + [new_beams[i] for i in has_nans]
+    im_f = backend.rfftn(cube_block, axes=(1, 2), s=fshape)
+    g_ratios = np.empty(len(cube_block))
+    for i, (old_beam, new_beam) in enumerate(zip(old_beams, new_beams)):
+        g_final, g_ratios[i] = get_kernel(
+            old_beam, new_beam, fshape, dx, dy, dtype=im_f.real.dtype
+        )
+        im_f[i] *= g_final
+    if out is not None:
+        _inverse_planes(im_f, g_ratios, fshape, backend, nchan, has_nans, blanks, out)
+        return out, g_ratios[:nchan]
+    im_conv = backend.irfftn(im_f, s=fshape, axes=(1, 2))[:, :nx, :ny]
+    del im_f
+    if has_nans:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for j, i in enumerate(has_nans):
+                weights = _weights(im_conv[nchan + j], g_ratios[nchan + j])
+                im_conv[i] /= weights
+                im_conv[i][blanks[j]] = np.nan
+        im_conv = im_conv[:nchan]
+        g_ratios = g_ratios[:nchan]
+    return im_conv, g_ratios
+
+
+def _weights(mask_conv, g_ratio):
+    """Fraction of the kernel on valid pixels, in place, from the smoothed mask
+
+    The kernel sums to g_ratio, so smoothing a plane of ones gives g_ratio.
+    Both the planes and their weights carry g_ratio; keep one copy, as the
+    plain path does.
+    """
+    mask_conv /= -g_ratio
+    mask_conv += 1
+    return mask_conv
+
+
+def _inverse_planes(im_f, g_ratios, fshape, backend, nchan, has_nans, blanks, out):
+    """Transform the spectra of _convolve_stack back into out, plane by plane
+
+    Does what _convolve_stack and the scaling by the factors do to the
+    stack, in the same order, one plane at a time.
+    """
+    nx, ny = out.shape[1:]
+    weights = {i: j for j, i in enumerate(has_nans)}
+    for i in range(nchan):
+        if i in weights:
+            # Before the plane, as a backend may reuse its output array
+            j = weights[i]
+            weight = backend.irfftn(im_f[nchan + j], s=fshape, axes=(0, 1))
+            weight = _weights(weight[:nx, :ny].copy(), g_ratios[nchan + j])
+        plane = backend.irfftn(im_f[i], s=fshape, axes=(0, 1))[:nx, :ny]
+        if i in weights:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                plane /= weight
+            plane[blanks[j]] = np.nan
+            del weight
+        plane *= g_ratios[i]
+        out[i] = plane
+
+
+def _tile_length(n, halo, limit):
+    """FFT length and core length of tiles along an axis of n pixels
+
+    Uses one tile if the whole axis (plus halos) fits in limit, otherwise the
+    largest core whose padded length is a fast FFT size no bigger than limit.
+    """
+    flen = scipy.fft.next_fast_len(n + 2 * halo, real=True)
+    if flen <= limit:
+        return flen, n
+    core = int(limit) - 2 * halo
+    while core > 0:
+        flen = scipy.fft.next_fast_len(core + 2 * halo, real=True)
+        if flen <= limit:
+            return flen, core
+        core -= 1
+    raise ValueError(
+        f"Memory limit is too small for tiles of {2 * halo} pixels of kernel support"
+    )
+
+
+def convolve_tiled(
+    image,
+    out,
+    old_beam,
+    new_beam,
+    dx,
+    dy,
+    max_memory,
+    backend=None,
+    nan_aware=False,
+    dtype=np.float64,
+):
+    """Convolve a plane out of core, tile by tile (overlap-save).
+
+    The plane is read in tiles that overlap by the half-width (+/- 5 sigma)
+    of the target beam, which bounds the convolving beam. Each tile is
+    zero-padded to a fast FFT size and convolved as in convolve, and only its
+    core, which is free of wrap-around, is written to out. The edges of the
+    plane are zero-padded, so the result matches convolve(..., pad=True) to
+    within the truncation of the kernel. Convolving beams narrower than a
+    pixel are not compact in the image plane, and tile edges then show at
+    the same level as --pad changes the result.
+
+    Both image and out may be memory-mapped, so only one tile is held in
+    memory at a time. Unlike convolve, the tiles written to out are already
+    multiplied by the scaling factor. Without nan_aware, a NaN anywhere in
+    the plane makes all of out NaN, as convolve does, and the remaining
+    tiles are not convolved.
+
+    Args:
+        image (2D array): Image to be convolved (e.g. a memmap).
+        out (2D array): Writeable array of the same shape for the result.
+        old_beam (radio_beam.Beam): Current image PSF.
+        new_beam (radio_beam.Beam): Target image PSF.
+        dx (Quantity): Grid size in x (e.g. CDELT1)
+        dy (Quantity): Grid size in y (e.g. CDELT2)
+        max_memory (int): Memory budget for the working arrays, in bytes.
+        backend (optional): FFT backend from fft_backends.get_backend.
+            Defaults to scipy.fft on all available CPUs.
+        nan_aware (bool, optional): Use normalised convolution to ignore NaNs.
+            Defaults to False.
+        dtype (dtype, optional): Working precision. Defaults to float64.
+
+    Returns:
+        float: scaling factor
+
+    Raises:
+        ValueError: If max_memory cannot hold a tile bigger than its halos.
+    """
+    nx, ny = image.shape
+    dtype = np.dtype(dtype)
+    hx, hy = _halfwidth(new_beam, dx), _halfwidth(new_beam, dy)
+    # Working arrays per FFT pixel: the padded tile, its half spectrum, the
+    # kernel, the inverse transform and the scaled core. Weights double it.
+    npix = max_memory // (5 * dtype.itemsize * (2 if nan_aware else 1))
+    # Rows are contiguous on disk, so let the tiles run along them first
+    fy, cy = _tile_length(ny, hy, int(np.sqrt(npix)))
+    fx, cx = _tile_length(nx, hx, npix // fy)
+    ntiles = int(np.ceil(nx / cx) * np.ceil(ny / cy))
+    log.debug(
+        f"Convolving {image.shape} in {ntiles} tiles of {(cx, cy)} on {(fx, fy)}"
+    )
+    g_ratio = None
+    for x0 in range(0, nx, cx):
+        x1 = min(x0 + cx, nx)
+        xs, xe = max(x0 - hx, 0), min(x1 + hx, nx)
+        for y0 in range(0, ny, cy):
+            y1 = min(y0 + cy, ny)
+            ys, ye = max(y0 - hy, 0), min(y1 + hy, ny)
+            tile = np.asarray(image[xs:xe, ys:ye], dtype=dtype)
+            if not nan_aware and np.isnan(tile).any():
+                # In one transform of the plane, the NaN would reach it all
+                log.warning("NaNs present in image -- blanking the output")
+                out[...] = np.nan
+                return get_kernel(old_beam, new_beam, (fx, fy), dx, dy, dtype)[1]
+            im_conv, g_ratios = _convolve_stack(
+                tile[np.newaxis],
+                [old_beam],
+                [new_beam],
+                dx,
+                dy,
+                (fx, fy),
+                backend=backend,
+                nan_aware=nan_aware,
+            )
+            g_ratio = g_ratios[0]
+            core = im_conv[0, x0 - xs : x1 - xs, y0 - ys : y1 - ys]
+            core *= g_ratio
+            out[x0:x1, y0:y1] = core
+    return g_ratio
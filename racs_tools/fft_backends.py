@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+""" Real-to-complex FFT backends for convolve_uv """
+
+import os
+import threading
+import functools
+import numpy as np
+import scipy.fft
+import logging as log
+
+BACKENDS = ["scipy", "numpy", "pyfftw"]
+
+
+def default_threads():
+    """Number of CPUs this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def mpi_threads(comm):
+    """FFT threads for each MPI rank
+
+    The CPUs of the node are split between the ranks running on it. Ranks
+    pinned to fewer CPUs get those. Collective -- every rank must call it.
+
+    Args:
+        comm (MPI.Comm): Communicator of the ranks
+
+    Returns:
+        int: Number of FFT threads
+    """
+    from mpi4py import MPI
+
+    node = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    ranks_per_node = node.Get_size()
+    node.Free()
+    return max(1, min(default_threads(), (os.cpu_count() or 1) // ranks_per_node))
+
+
+class NumpyBackend:
+    """numpy.fft -- single threaded. numpy < 2 upcasts float32 to double."""
+
+    name = "numpy"
+
+    def __init__(self, threads=1):
+        self.threads = 1
+
+    def rfftn(self, a, axes, s=None):
+        return np.fft.rfftn(a, s=s, axes=axes)
+
+    def irfftn(self, a, s, axes):
+        return np.fft.irfftn(a, s=s, axes=axes)
+
+
+class ScipyBackend:
+    """scipy.fft -- multi-threaded with `workers`, keeps single precision"""
+
+    name = "scipy"
+
+    def __init__(self, threads=1):
+        self.threads = threads
+
+    def rfftn(self, a, axes, s=None):
+        return scipy.fft.rfftn(a, s=s, axes=axes, workers=self.threads)
+
+    def irfftn(self, a, s, axes):
+        return scipy.fft.irfftn(a, s=s, axes=axes, workers=self.threads)
+
+
+class PyFFTWBackend:
+    """pyFFTW -- multi-threaded FFTW with plan reuse
+
+    Plans are built once per (shape, dtype, axes) and reused for every
+    subsequent plane.
+
+    To save a copy, rfftn hands back the plan's own output array. It is
+    overwritten by the next rfftn of the same shape in the same thread.
+
+    Args:
+        threads (int, optional): Number of FFTW threads. Defaults to 1.
+        planner_effort (str, optional): FFTW planner flag.
+            Defaults to 'FFTW_MEASURE'.
+    """
+
+    name = "pyfftw"
+
+    def __init__(self, threads=1, planner_effort="FFTW_MEASURE"):
+        try:
+            import pyfftw
+            import pyfftw.builders
+        except ImportError:
+            raise ImportError(
+                "pyfftw is not installed -- choose another FFT backend or "
+                "`pip install pyfftw`"
+            )
+        self._builders = pyfftw.builders
+        self.threads = threads
+        self.planner_effort = planner_effort
+        # FFTW objects hold their own input/output arrays, so they must not
+        # be shared between threads
+        self._local = threading.local()
+
+    def _plan(self, builder, a, **kwargs):
+        plans = getattr(self._local, "plans", None)
+        if plans is None:
+            plans = self._local.plans = {}
+        key = (builder, a.shape, a.dtype.str, tuple(sorted(kwargs.items())))
+        plan = plans.get(key)
+        if plan is None:
+            log.debug(f"Planning pyfftw {builder} for {a.shape} {a.dtype}")
+            plan = getattr(self._builders, builder)(
+                a,
+                threads=self.threads,
+                planner_effort=self.planner_effort,
+                **kwargs,
+            )
+            plans[key] = plan
+        return plan
+
+    def rfftn(self, a, axes, s=None):
+        if s is None:
+            s = [a.shape[axis] for axis in axes]
+        plan = self._plan("rfftn", a, s=tuple(s), axes=tuple(axes))
+        return plan(a)
+
+    def irfftn(self, a, s, axes):
+        plan = self._plan("irfftn", a, s=tuple(s), axes=tuple(axes))
+        # The output array belongs to the plan -- hand back a copy
+        return plan(a).copy()
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend(name="scipy", threads=None):
+    """Get an FFT backend. Backends are cached per process.
+
+    Args:
+        name (str, optional): One of 'scipy', 'numpy' or 'pyfftw'.
+            Defaults to 'scipy'.
+        threads (int, optional): Number of FFT threads. Defaults to all CPUs
+            available to this process.
+
+    Returns:
+        Backend with rfftn(a, axes, s=None) and irfftn(a, s, axes) methods.
+        As for numpy.fft, `s` zero-pads the input of rfftn.
+    """
+    if name == "numpy":
+        if threads is not None and threads > 1:
+            log.warning("numpy.fft is single threaded -- ignoring FFT threads")
+        return NumpyBackend()
+    if threads is None:
+        threads = default_threads()
+    if name == "scipy":
+        return ScipyBackend(threads)
+    elif name == "pyfftw":
+        return PyFFTWBackend(threads)
+    raise ValueError(f"Unknown FFT backend '{name}'. Choose from {BACKENDS}")
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+""" Chunked Zarr output stores, and their conversion to FITS """
+
+import os
+import json
+import numpy as np
+from astropy import units as u
+from astropy.io import fits
+from astropy.table import Table
+import logging as log
+
+FORMATS = ("fits", "zarr")
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError(
+            "zarr is not installed -- use '--output-format fits' or "
+            "`pip install racs-tools[zarr]`"
+        )
+    return zarr
+
+
+def storename(outfile):
+    """Name of the Zarr store that stands in for a FITS output"""
+    return os.path.splitext(outfile)[0] + ".zarr"
+
+
+def fitsname(store):
+    """Name of the FITS file a Zarr store is converted to"""
+    return os.path.splitext(store.rstrip("/"))[0] + ".fits"
+
+
+def isstore(path):
+    """Is path a Zarr array store (rather than a FITS file)?"""
+    return os.path.isfile(os.path.join(path, ".zarray"))
+
+
+def init_store(outfile, header, shape, axis=None, beams=None):
+    """Create a Zarr array store for an output image or cube
+
+    Cubes are chunked by channel -- one chunk per plane -- so each plane is
+    a file of its own. Writers that fill whole planes never touch the same
+    file, and the store writes each chunk to a temporary file and renames it
+    into place, so processes (e.g. MPI ranks) can fill a cube at once with no
+    locking. Chunks are not compressed, to keep writing cheap, and planes
+    left unwritten (or all NaN) read as NaN without being stored.
+
+    The FITS header is kept in the attributes, with the spectral axis and,
+    for cubes whose beam varies by channel, the beams (BMAJ and BMIN in
+    arcsec, BPA in deg).
+
+    Args:
+        outfile (str): Store to create. Overwritten if it exists.
+        header (Header): Primary header, with the (first) beam attached.
+        shape (tuple): Shape of the data, in numpy order.
+        axis (int, optional): Spectral axis of a cube. Defaults to None (an
+            image, stored in one chunk).
+        beams (Beams, optional): Beam of each channel. Defaults to None.
+
+    Returns:
+        Array: The Zarr array
+    """
+    zarr = _import_zarr()
+    if axis is None:
+        chunks = shape
+    else:
+        chunks = tuple(n if i >= len(shape) - 2 else 1 for i, n in enumerate(shape))
+    data = zarr.open_array(
+        outfile,
+        mode="w",
+        shape=shape,
+        chunks=chunks,
+        dtype="f4",
+        fill_value=np.nan,
+        compressor=None,
+        dimension_separator=".",
+        write_empty_chunks=False,
+    )
+    attrs = {"header": header.tostring(), "axis": axis}
+    if beams is not None:
+        attrs["beams"] = {
+            "BMAJ": beams.major.to_value(u.arcsec).tolist(),
+            "BMIN": beams.minor.to_value(u.arcsec).tolist(),
+            "BPA": beams.pa.to_value(u.deg).tolist(),
+        }
+    data.attrs.update(attrs)
+    return data
+
+
+def open_store(outfile, mode="r+"):
+    """Open a Zarr array store made by init_store"""
+    zarr = _import_zarr()
+    return zarr.open_array(outfile, mode=mode)
+
+
+def sync(outfile, spans):
+    """Sync the planes of channels written to a cube store to disk
+
+    Args:
+        outfile (str): Store
+        spans (list): (start, end) channel ranges written
+    """
+    with open(os.path.join(outfile, ".zarray")) as f:
+        ndim = len(json.load(f)["shape"])
+    with open(os.path.join(outfile, ".zattrs")) as f:
+        axis = json.load(f)["axis"]
+    for start, end in spans:
+        for chan in range(start, end):
+            key = ".".join(str(chan) if i == axis else "0" for i in range(ndim))
+            try:
+                fd = os.open(os.path.join(outfile, key), os.O_RDONLY)
+            except FileNotFoundError:
+                # A NaN plane, which is not stored
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    # Sync the directory too, for the names of the new chunks
+    fd = os.open(outfile, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def to_fits(store, outfile=None, nchan=16):
+    """Convert a Zarr store made by init_store to FITS
+
+    The data are copied a slab of channels at a time into a FITS file
+    allocated up front, so only nchan planes are held in memory. The beams
+    of a cube whose beam varies by channel go in a BEAMS table extension, as
+    beamcon_3D writes them.
+
+    Args:
+        store (str): Zarr store
+        outfile (str, optional): FITS file to write. Defaults to the store
+            name ending in .fits.
+        nchan (int, optional): Channels copied at a time. Defaults to 16.
+
+    Returns:
+        str: FITS file written
+    """
+    # beamcon_2D imports this module
+    from racs_tools.beamcon_2D import init_outfile
+
+    if outfile is None:
+        outfile = fitsname(store)
+    data = open_store(store, mode="r")
+    header = fits.Header.fromstring(data.attrs["header"])
+    log.info(f"Converting {store} to {outfile}")
+    init_outfile(outfile, header, data.shape)
+    beams = data.attrs.get("beams")
+    if beams is not None:
+        beam_table = Table(
+            data=[
+                beams["BMAJ"] * u.arcsec,
+                beams["BMIN"] * u.arcsec,
+                beams["BPA"] * u.deg,
+            ],
+            names=["BMAJ", "BMIN", "BPA"],
+        )
+        tab_hdu = fits.table_to_hdu(beam_table)
+        fits.append(outfile, tab_hdu.data, tab_hdu.header, verify=False)
+    axis = data.attrs.get("axis")
+    with fits.open(outfile, mode="update", memmap=True) as hdulist:
+        out = hdulist[0].data
+        if axis is None:
+            out[...] = data[...]
+        else:
+            for start in range(0, data.shape[axis], nchan):
+                index = tuple(
+                    slice(start, start + nchan) if i == axis else slice(None)
+                    for i in range(data.ndim)
+                )
+                out[index] = data[index]
+        del out
+    return outfile
+
+
+def main(args):
+    for store in args.stores:
+        if not isstore(store):
+            raise ValueError(f"{store} is not a Zarr array store")
+        to_fits(store, nchan=args.nchan)
+    log.info("Done!")
+
+
+def cli():
+    import argparse
+
+    descStr = """
+    Convert the Zarr stores written by beamcon_2D and beamcon_3D with
+    '--output-format zarr' to FITS. Each store <name>.zarr is written to
+    <name>.fits.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=descStr, formatter_class=argparse.RawTextHelpFormatter
+    )
+
+    parser.add_argument(
+        "stores", metavar="stores", type=str, help="Zarr stores to convert", nargs="+"
+    )
+
+    parser.add_argument(
+        "--nchan",
+        dest="nchan",
+        type=int,
+        default=16,
+        help="Number of channels to copy at a time [16].",
+    )
+
+    parser.add_argument(
+        "-v", "--verbosity", action="count", help="Increase output verbosity", default=0
+    )
+
+    args = parser.parse_args()
+
+    if args.verbosity == 1:
+        log.basicConfig(
+            level=log.INFO,
+            format="%(asctime)s %(module)s - %(funcName)s: %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+        )
+    elif args.verbosity >= 2:
+        log.basicConfig(
+            level=log.DEBUG,
+            format="%(asctime)s %(module)s - %(funcName)s: %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+        )
+
+    main(args)
+
+
+if __name__ == "__main__":
+    cli()
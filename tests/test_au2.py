@@ -0,0 +1,54 @@
+""" The array versions of au2 functions agree with the scalar versions """
+
+import numpy as np
+import pytest
+from racs_tools import au2
+
+N = 2000
+
+
+def random_beams(rng, n=N):
+    major = rng.uniform(5, 30, n)
+    minor = major * rng.uniform(0.3, 1, n)
+    pa = rng.uniform(-90, 90, n)
+    return major, minor, pa
+
+
+@pytest.fixture
+def beams():
+    rng = np.random.default_rng(2022)
+    orig = random_beams(rng)
+    conv = random_beams(rng)
+    # Half the targets are the original beams convolved with another, which
+    # deconvolve cleanly; the rest are random, and often fail
+    target = tuple(np.array(x) for x in random_beams(rng))
+    _, _, bmaj, bmin, bpa = au2.gauss_factor_array(conv, orig)
+    half = slice(0, N // 2)
+    for x, y in zip(target, (bmaj, bmin, bpa)):
+        x[half] = y[half]
+    return orig, target
+
+
+def test_gaussianDeconvolve_array(beams):
+    orig, target = beams
+    result = au2.gaussianDeconvolve_array(*target, *orig)
+    expected = np.array(
+        [au2.gaussianDeconvolve(*args) for args in zip(*target, *orig)]
+    ).T
+    assert (result[0][: N // 2] > 0).all()
+    for x, y in zip(result, expected):
+        # Agrees to rounding, not to the last bit
+        np.testing.assert_allclose(x, y, rtol=1e-12, atol=1e-10)
+
+
+def test_gauss_factor_array(beams):
+    orig, target = beams
+    result = au2.gauss_factor_array(target, orig, dx1=2.5, dy1=2.5)
+    expected = np.array(
+        [
+            au2.gauss_factor(args[:3], args[3:], dx1=2.5, dy1=2.5)
+            for args in zip(*target, *orig)
+        ]
+    ).T
+    for x, y in zip(result, expected):
+        np.testing.assert_allclose(x, y, rtol=1e-12, atol=1e-10)
@@ -0,0 +1,40 @@
+""" Scheduling of blocks of planes in beamcon_3D """
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from racs_tools.beamcon_3D import Prefetcher, imap_bounded
+
+NBLOCKS = 40
+NTHREADS = 2
+DEPTH = 2
+
+
+def test_prefetch_bounded():
+    """Blocks are only read a few ahead of the results taken"""
+    lock = threading.Lock()
+    read = []
+
+    def read_block(block):
+        with lock:
+            read.append(block)
+        return block
+
+    def smooth(block):
+        time.sleep(0.01)
+        return block
+
+    reader = Prefetcher(range(NBLOCKS), read_block, depth=DEPTH)
+    # Submitted to the pool, queued by the reader, and being read
+    most = NTHREADS + DEPTH + 1
+    try:
+        with ThreadPool(NTHREADS) as pool:
+            results = imap_bounded(pool, smooth, reader, NTHREADS)
+            for taken, block in enumerate(results, start=1):
+                time.sleep(0.01)
+                with lock:
+                    assert len(read) - taken <= most
+                assert block == taken - 1
+    finally:
+        reader.close()
+    assert taken == NBLOCKS
@@ -0,0 +1,117 @@
+""" The common beam solver agrees with radio_beam and holds every beam """
+
+import functools
+import numpy as np
+import pytest
+from astropy import units as u
+from radio_beam import Beams
+from racs_tools import commonbeam
+from racs_tools.beamcon_3D import solve_total
+from racs_tools.beamtable import BeamTable
+
+
+def random_beams(rng, n, roundness=(0.5, 1)):
+    major = rng.uniform(10, 20, n)
+    minor = major * rng.uniform(*roundness, n)
+    pa = rng.uniform(-90, 90, n)
+    return BeamTable(major, minor, pa)
+
+
+def beam_sets():
+    rng = np.random.default_rng(2022)
+    return {
+        "random": random_beams(rng, 300),
+        "few": random_beams(rng, 5),
+        "near_circular": random_beams(rng, 30, (1 - 1e-7, 1)),
+        "identical": BeamTable([12] * 10, [8] * 10, [30] * 10),
+        "dominated": BeamTable(
+            np.r_[20, rng.uniform(5, 10, 20)],
+            np.r_[19, rng.uniform(4, 5, 20)],
+            np.r_[10, rng.uniform(-90, 90, 20)],
+        ),
+        "two": BeamTable([12, 12], [6, 6], [0, 90]),
+        "three_way": BeamTable([12, 12, 12], [6, 6, 6], [0, 60, -60]),
+    }
+
+
+def assert_same_beam(beam, expected):
+    """Same area, and nearly the same axes and orientation
+
+    The tolerance of Khachiyan's algorithm bounds the area of the beam. For
+    near-circular sets the axes can trade off against each other by more.
+    """
+    np.testing.assert_allclose(
+        beam.major * beam.minor, expected.major * expected.minor, rtol=1e-3
+    )
+    np.testing.assert_allclose(beam.major, expected.major, rtol=5e-3)
+    np.testing.assert_allclose(beam.minor, expected.minor, rtol=5e-3)
+    cov = np.array(commonbeam.covariance(beam)).ravel()
+    expected_cov = np.array(commonbeam.covariance(expected)).ravel()
+    np.testing.assert_allclose(cov, expected_cov, atol=1e-2 * expected_cov.max())
+
+
+@pytest.mark.parametrize("name", sorted(beam_sets()))
+def test_common_beam(name):
+    beams = beam_sets()[name]
+    common = commonbeam.common_beam(beams)
+    assert commonbeam.contains(common, beams).all()
+    expected = Beams(
+        beams.major * u.arcsec, beams.minor * u.arcsec, beams.pa * u.deg
+    ).common_beam()
+    assert_same_beam(common, BeamTable.from_beams(expected))
+
+
+def test_common_beam_nans():
+    """NaN (masked) beams are ignored"""
+    beams = beam_sets()["random"]
+    masked = BeamTable.from_data(beams.data.copy())
+    masked.data[::7] = np.nan
+    common = commonbeam.common_beam(masked)
+    expected = commonbeam.common_beam(masked[~masked.isnan()])
+    assert common == expected
+
+
+def test_warm_start():
+    """Warm starts over similar channels give the cold start's beam"""
+    rng = np.random.default_rng(1)
+    base = random_beams(rng, 100)
+    solver = commonbeam.CommonBeamSolver()
+    for _ in range(10):
+        beams = BeamTable(
+            base.major * rng.uniform(0.98, 1.02, len(base)),
+            base.minor * rng.uniform(0.98, 1, len(base)),
+            base.pa + rng.uniform(-2, 2, len(base)),
+        )
+        warm = solver.solve(beams)
+        cold = commonbeam.CommonBeamSolver().solve(beams, warm=False)
+        assert commonbeam.contains(warm, beams).all()
+        assert_same_beam(warm, cold)
+
+
+@pytest.mark.parametrize("nparts", [1, 3, 8])
+def test_merge_hulls(nparts):
+    """Hulls of the parts, merged in a tree, give the common beam of all"""
+    rng = np.random.default_rng(nparts)
+    beams = random_beams(rng, 1000)
+    parts = np.array_split(np.arange(len(beams)), nparts)
+    hulls = [commonbeam.hull_beams(beams[part]) for part in parts]
+    while len(hulls) > 1:
+        pairs = [hulls[i : i + 2] for i in range(0, len(hulls), 2)]
+        hulls = [functools.reduce(commonbeam.merge_hulls, pair) for pair in pairs]
+    common = commonbeam.common_beam(hulls[0])
+    assert commonbeam.contains(common, beams).all()
+    assert common == commonbeam.common_beam(beams)
+
+
+def test_solve_total():
+    """The tree reduction over cubes and channel ranges matches a flat solve"""
+    rng = np.random.default_rng(7)
+    nchans, ncubes = 100, 3
+    beams = random_beams(rng, nchans * ncubes)
+    big_beams = BeamTable.from_data(beams.data.reshape(nchans, ncubes))
+    big_beams.data[5, 1] = np.nan
+    common = solve_total(big_beams, 1e-4, 200, 5e-4, block_size=16)
+    flat = BeamTable.from_data(big_beams.data.ravel())
+    flat = flat[~flat.isnan()]
+    assert commonbeam.contains(common, flat).all()
+    assert common == commonbeam.common_beam(flat)
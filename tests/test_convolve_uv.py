@@ -0,0 +1,172 @@
+""" Memory use and results of smoothing a block of planes """
+
+import tracemalloc
+import numpy as np
+import pytest
+from astropy import units as u
+from radio_beam import Beam, Beams
+from racs_tools import convolve_uv, fft_backends
+from racs_tools.beamcon_3D import smooth_stack
+
+NCHAN, NY, NX = 4, 512, 512
+DX = DY = 2.5 * u.arcsec
+
+# Most allocated while smoothing a block, in multiples of the (float32)
+# block, once the work buffers are warm. In float64 that is the half
+# spectrum (2x) and one plane at a time on the way back.
+BOUNDS = {
+    ("float64", "robust"): 4,
+    ("float64", "robust_nan"): 6.5,
+    ("float32", "robust"): 2,
+    ("float32", "robust_nan"): 4,
+}
+
+
+def beams():
+    old = Beams(
+        major=[10, 11, 12, 13] * u.arcsec,
+        minor=[8, 9, 10, 11] * u.arcsec,
+        pa=[0, 10, 20, 30] * u.deg,
+    )
+    new = Beams(
+        major=[20] * NCHAN * u.arcsec,
+        minor=[20] * NCHAN * u.arcsec,
+        pa=[0] * NCHAN * u.deg,
+    )
+    con = Beams(beams=[n.deconvolve(o) for n, o in zip(new, old)])
+    return old, new, con
+
+
+def block(conv_mode, seed=0):
+    planes = np.random.default_rng(seed).normal(size=(NCHAN, NY, NX))
+    planes = planes.astype(np.float32)
+    if conv_mode == "robust_nan":
+        planes[:, 100:104, 50:60] = np.nan
+    return planes
+
+
+def convolve_full(image, old_beam, new_beam, dx, dy):
+    """The complex-to-complex convolution that convolve replaced"""
+    u_ = np.fft.fftfreq(image.shape[0], d=dx.to(u.rad).value)
+    v_ = np.fft.fftfreq(image.shape[1], d=dy.to(u.rad).value)
+    g_final, g_ratio = convolve_uv.gaussft.gaussft(
+        bmin_in=old_beam.minor.to(u.deg).value,
+        bmaj_in=old_beam.major.to(u.deg).value,
+        bpa_in=old_beam.pa.to(u.deg).value,
+        bmin=new_beam.minor.to(u.deg).value,
+        bmaj=new_beam.major.to(u.deg).value,
+        bpa=new_beam.pa.to(u.deg).value,
+        u=u_,
+        v=v_,
+        nx=len(u_),
+        ny=len(v_),
+    )
+    return np.real(np.fft.ifft2(np.fft.fft2(image) * g_final)), g_ratio
+
+
+@pytest.mark.parametrize("shape", [(64, 64), (64, 63), (63, 64), (63, 63)])
+def test_convolve_matches_full_fft(shape):
+    """The real-to-complex transform gives the full transform's result
+
+    A convolving beam narrower than a pixel keeps the kernel well away from
+    zero at the Nyquist frequencies, where the two differ if mishandled.
+    """
+    convolve_uv.clear_kernel_cache()
+    old_beam = Beam(3 * u.arcsec, 2 * u.arcsec, 30 * u.deg)
+    new_beam = Beam(3.3 * u.arcsec, 2.6 * u.arcsec, 60 * u.deg)
+    image = np.random.default_rng(0).normal(size=shape)
+    expected, expected_fac = convolve_full(image, old_beam, new_beam, DX, DY)
+    result, fac = convolve_uv.convolve(image, old_beam, new_beam, DX, DY)
+    assert fac == expected_fac
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("precision,conv_mode", sorted(BOUNDS))
+def test_smooth_stack_peak(precision, conv_mode):
+    backend = fft_backends.get_backend("scipy", 1)
+    old, new, con = beams()
+
+    def smooth(images):
+        return smooth_stack(
+            images,
+            DX,
+            DY,
+            old,
+            new,
+            con,
+            np.ones(NCHAN),
+            conv_mode=conv_mode,
+            precision=precision,
+            backend=backend,
+        )
+
+    # Warm the work buffers and the kernel cache
+    smooth(block(conv_mode))
+    images = block(conv_mode, seed=1)
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        smooth(images)
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    assert peak < BOUNDS[precision, conv_mode] * images.nbytes
+
+
+@pytest.mark.parametrize("nan_aware", [False, True])
+def test_convolve_stack_out(nan_aware):
+    """Writing to out gives the scaled planes, to the last bit"""
+    old, new, _ = beams()
+    planes = block("robust_nan" if nan_aware else "robust").astype(np.float64)
+    expected, facs = convolve_uv.convolve_stack(
+        planes, old, new, DX, DY, nan_aware=nan_aware
+    )
+    expected = expected * facs[:, np.newaxis, np.newaxis]
+    out = np.empty(planes.shape, dtype=np.float32)
+    result, _ = convolve_uv.convolve_stack(
+        planes, old, new, DX, DY, nan_aware=nan_aware, out=out
+    )
+    assert result is out
+    np.testing.assert_array_equal(out, expected.astype(np.float32))
+
+
+@pytest.mark.parametrize("nan_aware", [False, True])
+@pytest.mark.parametrize("blank", [(100, 50), (2, 300), (300, 0)])
+def test_convolve_tiled_nans(nan_aware, blank):
+    """Tiled output matches the padded output in memory, NaNs and edges too"""
+    old, new, _ = beams()
+    image = block("robust")[0].astype(np.float64) + 1
+    image[blank] = np.nan
+    expected, fac = convolve_uv.convolve(
+        image, old[0], new[0], DX, DY, pad=True, nan_aware=nan_aware
+    )
+    out = np.zeros(image.shape, dtype=np.float64)
+    tiled_fac = convolve_uv.convolve_tiled(
+        image, out, old[0], new[0], DX, DY, 2 ** 20, nan_aware=nan_aware
+    )
+    assert tiled_fac == pytest.approx(fac)
+    np.testing.assert_array_equal(np.isnan(out), np.isnan(expected))
+    if nan_aware:
+        # The budget gives dozens of tiles, most of them without the blank
+        expected *= fac
+        np.testing.assert_allclose(out, expected, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("pad", [False, True])
+def test_convolve_stack_nan_edges(pad):
+    """One NaN does not change the plane away from it, edges included"""
+    old, new, _ = beams()
+    planes = block("robust").astype(np.float64)
+    planes[1] = 1
+    blanked = planes.copy()
+    blanked[1, 200, 300] = np.nan
+    clean, _ = convolve_uv.convolve_stack(
+        planes, old, new, DX, DY, pad=pad, nan_aware=True
+    )
+    result, _ = convolve_uv.convolve_stack(
+        blanked, old, new, DX, DY, pad=pad, nan_aware=True
+    )
+    far = np.ones((NY, NX), dtype=bool)
+    far[150:251, 250:351] = False
+    np.testing.assert_allclose(result[1][far], clean[1][far], rtol=1e-9)
+    np.testing.assert_array_equal(result[[0, 2, 3]], clean[[0, 2, 3]])